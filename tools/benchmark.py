@@ -0,0 +1,104 @@
+import argparse
+import datetime
+import decimal
+import io
+import timeit
+
+from pickle_loader import PICKLE_PATH, load_module
+
+
+N = 100_000
+
+WORKLOADS = {
+    "small ints (BININT1)": lambda: [i % 256 for i in range(N)],
+    "ints (BININT2)": lambda: [256 + i % 60000 for i in range(N)],
+    "ints (BININT)": lambda: [70000 + i for i in range(N)],
+    "short strings": lambda: ["s%d" % i for i in range(N)],
+    "short bytes": lambda: [b"b%d" % i for i in range(N)],
+    "memo gets": lambda: [x for x in [["x"] for _ in range(200)] for _ in range(N // 200)],
+    "datetimes": lambda: [datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i)
+                          for i in range(N)],
+    "decimals": lambda: [decimal.Decimal(i) / 100 for i in range(N)],
+    "complex": lambda: [complex(i, -i) for i in range(N)],
+}
+
+
+def time_dumps(modules: list, obj, protocol: int, repeat: int) -> list:
+    """Return the best time in nanoseconds per element to pickle obj with the
+    pure-Python Pickler of each module.  Runs are interleaved so that noise
+    affects all modules alike."""
+    best = [float("inf")] * len(modules)
+    for _ in range(repeat):
+        for i, module in enumerate(modules):
+            elapsed = timeit.timeit(
+                lambda: module._Pickler(io.BytesIO(), protocol).dump(obj), number=1)
+            best[i] = min(best[i], elapsed)
+    return [t / len(obj) * 1e9 for t in best]
+
+
+MESSAGE = {"id": 12345, "name": "sensor-7", "ok": True, "values": [1.5, 2.5, 3.5],
+           "tags": ("a", "b")}
+
+
+def time_messages(module, protocol: int, repeat: int, number: int = 2000) -> list:
+    """Return the best time in microseconds to dump MESSAGE with one reused
+    instance of the pure-Python Pickler and of specialized_pickler()."""
+    f = io.BytesIO()
+    picklers = [module._Pickler(f, protocol), module.specialized_pickler(protocol)(f)]
+    best = [float("inf")] * len(picklers)
+    for _ in range(repeat):
+        for i, pickler in enumerate(picklers):
+            def dump():
+                f.seek(0)
+                pickler.clear_memo()
+                pickler.dump(MESSAGE)
+            best[i] = min(best[i], timeit.timeit(dump, number=number))
+    return [t / number * 1e6 for t in best]
+
+
+def run(baseline: str, protocols: list, repeat: int):
+    current = load_module(PICKLE_PATH, "my_pickle_current")
+    modules = [("current", current)]
+    if baseline:
+        modules.insert(0, ("baseline", load_module(baseline, "my_pickle_baseline")))
+
+    header = f"{'workload':<24}{'proto':>6}" + "".join(f"{label:>12}" for label, _ in modules)
+    if baseline:
+        header += f"{'gain':>9}"
+    print(header)
+    for name, make in WORKLOADS.items():
+        obj = make()
+        for protocol in protocols:
+            times = time_dumps([module for _, module in modules], obj, protocol, repeat)
+            line = f"{name:<24}{protocol:>6}" + "".join(f"{t:>9.1f} ns" for t in times)
+            if baseline:
+                line += f"{(times[0] - times[1]) / times[0]:>8.1%}"
+            print(line)
+
+    print()
+    print(f"{'small messages':<24}{'proto':>6}{'Pickler':>12}{'specialized':>15}")
+    for protocol in protocols:
+        plain, specialized = time_messages(current, protocol, repeat)
+        print(f"{'one reused instance':<24}{protocol:>6}{plain:>9.1f} us{specialized:>12.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark of the per-element cost of pickling small objects."
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Path to another copy of my_pickle.py to compare against, "
+             "e.g. one checked out with 'git show REV:path > old.py'"
+    )
+    parser.add_argument(
+        "--protocol", type=int, action="append",
+        help="Protocol to benchmark; may be repeated (default: 2 and 5)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=15,
+        help="Number of timing runs; the best one is reported"
+    )
+
+    args = parser.parse_args()
+    run(args.baseline, args.protocol or [2, 5], args.repeat)
@@ -0,0 +1,58 @@
+import argparse
+import importlib
+import os
+import sys
+
+from pickle_loader import PICKLE_PATH, load_module
+
+
+def load_workload(spec: str):
+    """Return the samples of a workload given as 'module:function', where
+    function returns an iterable of representative objects."""
+    module_name, _, function_name = spec.partition(":")
+    if not function_name:
+        raise SystemExit(f"workload must be given as module:function, not {spec!r}")
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name)()
+
+
+def run(workload: str, path: str, update: bool, start: int, size: int, protocol: int):
+    pickle = load_module(PICKLE_PATH, "my_pickle")
+    previous = pickle.ExtensionRegistry.load(path) if update and os.path.exists(path) else None
+    registry = pickle.ExtensionRegistry.train(load_workload(workload), previous,
+                                              start=start, size=size, protocol=protocol)
+    registry.save(path)
+    known = previous.codes if previous is not None else {}
+    for (module, name), code in sorted(registry.codes.items(), key=lambda item: item[1]):
+        mark = "" if (module, name) in known else "  (new)"
+        print(f"{code:>10}  {module}.{name}{mark}")
+    print(f"{len(registry)} extension codes, version {registry.version}, written to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Assign extension codes to the globals that a sample workload "
+                    "pickles most often, and save them as a registry file to be "
+                    "loaded with ExtensionRegistry.load(path).install()."
+    )
+    parser.add_argument("workload", help="Samples to profile, as module:function")
+    parser.add_argument("registry", help="Path of the JSON registry file to write")
+    parser.add_argument(
+        "--update", action="store_true",
+        help="Keep the codes of an existing registry file and only add new ones"
+    )
+    parser.add_argument(
+        "--start", type=int, default=240,
+        help="First code to assign (default: 240, the start of the private range)"
+    )
+    parser.add_argument(
+        "--size", type=int, default=256,
+        help="Maximum number of new codes (default: 256)"
+    )
+    parser.add_argument(
+        "--protocol", type=int,
+        help="Protocol to profile with (default: the default protocol)"
+    )
+
+    args = parser.parse_args()
+    run(args.workload, args.registry, args.update, args.start, args.size, args.protocol)
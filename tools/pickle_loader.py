@@ -0,0 +1,14 @@
+import importlib.util
+import os
+
+
+PICKLE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "whitebox_test",
+                           "statement_coverage_and_branch_coverage", "my_pickle.py")
+
+
+def load_module(path: str, name: str):
+    """Import the Python file at path as a module called name."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -1,10 +1,21 @@
+import io
 import sys
+import array
+import asyncio
+import socket
+import struct
+import copyreg
+import collections
+import decimal
 import hashlib
+import importlib.util
 import math
+import pickletools
 import platform
 import pytest
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime, time, timedelta, timezone
+from enum import Enum
 
 # Ensure that the C implementation of pickle is not used,
 # so that coverage can be calculated correctly
@@ -354,4 +365,857 @@ def test_save_type(protocol):
         with open("data.pkl", "wb") as f:
             pickle.dump(obj, f, protocol=protocol)
 
-        save_test_result(obj, protocol, hash_value)
\ No newline at end of file
+        save_test_result(obj, protocol, hash_value)
+
+# Test of the asyncio stream shorthands
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_async_stream(protocol):
+    """Test dump_async/load_async over a socket pair, two messages in a row"""
+    test_cases = [
+        {"name": "Alice", "data": list(range(100))},
+        b'x' * (200 * 1024),     # Several frames and a large payload
+    ]
+
+    async def send(writer):
+        for obj in test_cases:
+            await pickle.dump_async(obj, writer, protocol=protocol)
+
+    async def receive(reader):
+        return [await pickle.load_async(reader) for _ in test_cases]
+
+    async def roundtrip():
+        rsock, wsock = socket.socketpair()
+        reader, rwriter = await asyncio.open_connection(sock=rsock)
+        wreader, writer = await asyncio.open_connection(sock=wsock)
+        try:
+            _, received = await asyncio.gather(send(writer), receive(reader))
+            assert received == test_cases
+        finally:
+            writer.close()
+            rwriter.close()
+
+    asyncio.run(roundtrip())
+
+# Test of the asyncio reader's read-ahead
+@pytest.mark.parametrize("protocol", [0, 2])
+def test_async_stream_unframed(protocol):
+    """Test that unframed pickles are not read one opcode per round trip"""
+    test_cases = [list(range(50000)), {"name": "Alice"}]
+
+    class CountingReader:
+        def __init__(self, reader):
+            self.reader = reader
+            self.reads = 0
+
+        async def read(self, n):
+            self.reads += 1
+            return await self.reader.read(n)
+
+    async def roundtrip():
+        rsock, wsock = socket.socketpair()
+        reader, rwriter = await asyncio.open_connection(sock=rsock)
+        wreader, writer = await asyncio.open_connection(sock=wsock)
+        counting = CountingReader(reader)
+        try:
+            async def send():
+                for obj in test_cases:
+                    await pickle.dump_async(obj, writer, protocol=protocol)
+
+            async def receive():
+                return [await pickle.load_async(counting) for _ in test_cases]
+
+            _, received = await asyncio.gather(send(), receive())
+            assert received == test_cases
+            assert counting.reads < 1000
+        finally:
+            writer.close()
+            rwriter.close()
+
+    asyncio.run(roundtrip())
+
+# Test of the background frame read-ahead
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_load_readahead(protocol):
+    """Test loading back-to-back pickles with frames read ahead by a thread"""
+    test_cases = [
+        {"meta": {"version": 2.1}, "data": list(range(20000))},
+        b'x' * (70 * 1024),      # Large payload outside of any frame
+        "tail",
+    ]
+
+    f = io.BytesIO()
+    for obj in test_cases:
+        pickle.dump(obj, f, protocol=protocol)
+
+    for depth in (1, 4):
+        f.seek(0)
+        for obj in test_cases:
+            assert pickle.load(f, readahead=depth) == obj
+        assert f.read() == b''
+
+# Test of the background frame writer
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_dump_writebehind(protocol):
+    """Test that the writer thread keeps the output and surfaces errors"""
+    obj = {"data": list(range(20000)), "blob": b'x' * (70 * 1024)}
+
+    f = io.BytesIO()
+    pickle.dump(obj, f, protocol=protocol, writebehind=2)
+    assert f.getvalue() == pickle.dumps(obj, protocol=protocol)
+
+    class FailingFile:
+        def write(self, data):
+            raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        pickle.dump(obj, FailingFile(), protocol=protocol, writebehind=2)
+
+# Test of the pickler's output buffering
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_dump_buffering(protocol):
+    """Test that every protocol writes in chunks rather than per opcode"""
+    class CountingFile(io.BytesIO):
+        writes = 0
+
+        def write(self, data):
+            self.writes += 1
+            return super().write(data)
+
+    obj = list(range(20000))
+    f = CountingFile()
+    pickle.dump(obj, f, protocol=protocol)
+    assert f.writes < 10
+    assert pickle.loads(f.getvalue()) == obj
+
+# Test of the unpickler's read buffer
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_load_buffered(protocol, tmp_path):
+    """Test that over-read bytes go back to the file or to the remainder"""
+    test_cases = [
+        {"name": "Alice", "data": list(range(5000))},
+        b'x' * (70 * 1024),
+    ]
+    path = tmp_path / "data.pkl"
+    with open(path, "wb") as f:
+        for obj in test_cases:
+            pickle.dump(obj, f, protocol=protocol)
+        f.write(b"trailer")
+
+    # Raw seekable file: buffered by default, extra bytes are seeked back
+    with open(path, "rb", buffering=0) as f:
+        for obj in test_cases:
+            assert pickle.load(f) == obj
+        assert f.read() == b"trailer"
+
+    # Non-seekable file: extra bytes are exposed as the remainder
+    class Pipe:
+        def __init__(self, data):
+            self._f = io.BytesIO(data)
+            self.read = self._f.read
+            self.readline = self._f.readline
+
+    pipe = Pipe(path.read_bytes())
+    unpickler = pickle.Unpickler(pipe, buffered=True)
+    for obj in test_cases:
+        assert unpickler.load() == obj
+    assert unpickler.remainder + pipe.read() == b"trailer"
+
+# Test of memory-mapped loading
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_load_mmap(protocol, tmp_path):
+    """Test decoding straight from a memory map of the pickle file"""
+    test_cases = [
+        {"text": '中文字符' * 20000, "blob": bytearray(b'x' * (70 * 1024))},
+        b'y' * (70 * 1024),      # Large payload outside of any frame
+    ]
+    path = tmp_path / "data.pkl"
+    with open(path, "wb") as f:
+        for obj in test_cases:
+            pickle.dump(obj, f, protocol=protocol)
+        f.write(b"trailer")
+
+    with open(path, "rb") as f:
+        for obj in test_cases:
+            assert pickle.load(f, use_mmap=True) == obj
+        assert f.read() == b"trailer"
+
+    with open(path, "rb") as f:
+        pickle.load(f, use_mmap=True)
+        view = pickle.load(f, use_mmap=True, zero_copy=True)
+        if protocol == -1 or protocol >= 3:
+            assert isinstance(view, memoryview) and view.readonly
+        assert bytes(view) == test_cases[1]
+
+# Test of the shared-memory transport
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_dumps_shared(protocol):
+    """Test the shared-memory transport and its buffer layout"""
+    obj = {"list": [1, 2.0, "three"], "blob": b'x' * 1000}
+    if 0 <= protocol < 5:
+        with pytest.raises(ValueError):
+            pickle.dumps_shared(obj, protocol)
+        return
+    data, segment = pickle.dumps_shared(obj, protocol)
+    if segment is None:
+        assert data == pickle.dumps(obj, protocol)
+    assert pickle.loads_shared(data, segment) == obj
+
+    views = [memoryview(b'a' * 10), memoryview(bytearray(100)), memoryview(b'')]
+    layout, size = pickle._layout_buffers(views)
+    assert layout == [(0, 10, True), (64, 100, False), (192, 0, True)]
+    assert size == 192
+
+# Fixture giving my_pickle the real PickleBuffer
+@pytest.fixture
+def buffer_pickle(monkeypatch):
+    """A copy of my_pickle that sees the real PickleBuffer of _pickle"""
+    monkeypatch.delitem(sys.modules, "_pickle")
+    spec = importlib.util.spec_from_file_location("my_pickle_with_buffers",
+                                                  pickle.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module._HAVE_PICKLE_BUFFER
+    return module
+
+# Test of the shared-memory transport with real buffers
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX shared memory only")
+def test_dumps_shared_buffers(buffer_pickle):
+    """Test the shared-memory transport with real out-of-band buffers"""
+    from multiprocessing import shared_memory
+    obj = [buffer_pickle.PickleBuffer(b'a' * 10),
+           buffer_pickle.PickleBuffer(bytearray(b'b' * 100))]
+    data, segment = buffer_pickle.dumps_shared(obj, 5)
+    name, layout = segment
+    assert layout == ((0, 10, True), (64, 100, False))
+
+    first, second = buffer_pickle.loads_shared(data, segment)
+    assert bytes(first) == b'a' * 10 and bytes(second) == b'b' * 100
+    assert first.readonly and not second.readonly
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name)
+    second[0] = ord('c')
+    assert bytes(second[:2]) == b'cb'
+    del first, second
+
+    data, segment = buffer_pickle.dumps_shared(obj, 5)
+    first, second = buffer_pickle.loads_shared(data, segment, unlink=False)
+    shm = shared_memory.SharedMemory(segment[0])
+    assert bytes(shm.buf[64:164]) == b'b' * 100
+    shm.close()
+    shm.unlink()
+
+# Test of the buffer sidecar file
+@pytest.mark.parametrize("protocol", [-1, 5])
+def test_dump_with_sidecar(protocol, tmp_path):
+    """Test pickling to a file with a memory-mapped buffer sidecar"""
+    obj = {"list": [1, 2.0, "three"], "blob": b'x' * 1000}
+    path = tmp_path / "data.pkl"
+    pickle.dump_with_sidecar(obj, path, protocol)
+    assert (tmp_path / "data.pkl.buffers").exists()
+    assert pickle.load_with_sidecar(path) == obj
+
+    sidecar = tmp_path / "other"
+    pickle.dump_with_sidecar(obj, path, protocol, sidecar=sidecar)
+    assert pickle.load_with_sidecar(path, sidecar=sidecar) == obj
+
+    with open(sidecar, "r+b") as f:
+        f.write(b"garbage")
+    with pytest.raises(pickle.UnpicklingError):
+        pickle.load_with_sidecar(path, sidecar=sidecar)
+    with open(sidecar, "wb") as f:
+        f.write(b"PKLBUF")
+    with pytest.raises(pickle.UnpicklingError):
+        pickle.load_with_sidecar(path, sidecar=sidecar)
+    with open(sidecar, "wb") as f:
+        pass
+    with pytest.raises(pickle.UnpicklingError):
+        pickle.load_with_sidecar(path, sidecar=sidecar)
+
+# Test of the buffer sidecar file with real buffers
+def test_dump_with_sidecar_buffers(buffer_pickle, tmp_path):
+    """Test the sidecar layout with real out-of-band buffers"""
+    obj = [buffer_pickle.PickleBuffer(b'a' * 10),
+           buffer_pickle.PickleBuffer(bytearray(b'b' * 100)),
+           buffer_pickle.PickleBuffer(b'')]
+    path = tmp_path / "data.pkl"
+    buffer_pickle.dump_with_sidecar(obj, path, 5)
+    raw = (tmp_path / "data.pkl.buffers").read_bytes()
+    entries = list(struct.iter_unpack("<QQQ", raw[16:16 + 3 * 24]))
+    assert raw[:16] == struct.pack("<8sQ", b"PKLBUF\x00\x01", 3)
+    assert entries == [(128, 10, 1), (192, 100, 0), (320, 0, 1)]
+    assert raw[128:138] == b'a' * 10 and raw[192:292] == b'b' * 100
+    assert len(raw) == 320
+
+    first, second, third = buffer_pickle.load_with_sidecar(path)
+    assert bytes(first) == b'a' * 10 and bytes(second) == b'b' * 100
+    assert first.readonly and not second.readonly and third.readonly
+    assert len(third) == 0
+    second[0] = ord('c')
+    assert bytes(second[:2]) == b'cb'
+    assert (tmp_path / "data.pkl.buffers").read_bytes() == raw
+
+# Test of reading payloads into allocated buffers
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_load_allocator(protocol, tmp_path):
+    """Test reading large payloads into buffers from an allocator"""
+    sizes = []
+
+    def allocator(n):
+        sizes.append(n)
+        return bytearray(n)
+
+    obj = [bytearray(b'x' * (70 * 1024)), b'y' * (70 * 1024), bytearray(b'z')]
+    data = pickle.dumps(obj, protocol)
+    assert pickle.loads(data, allocator=allocator) == obj
+    if protocol == -1 or protocol >= 3:
+        assert sizes == [70 * 1024] * 2
+
+    path = tmp_path / "data.pkl"
+    path.write_bytes(data)
+    for kwargs in [{}, {"buffered": True}, {"readahead": 2}]:
+        with open(path, "rb", buffering=0) as f:
+            assert pickle.load(f, allocator=allocator, **kwargs) == obj
+
+    if protocol == -1 or protocol >= 3:
+        with pytest.raises(pickle.UnpicklingError):
+            pickle.loads(data, allocator=lambda n: bytearray(n + 1))
+        with pytest.raises(pickle.UnpicklingError):
+            pickle.loads(data[:len(data) // 2], allocator=allocator)
+
+# Test of huge strings written in chunks
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_dump_large_str(protocol, monkeypatch):
+    """Test that huge strings are written in chunks without changing the output"""
+    test_cases = ['a' * 100000, '中文字符' * 30000,
+                  'x' * 50000 + '𐀀' + '€' * 50000]
+    monkeypatch.setattr(pickle._Framer, "_LARGE_CHUNK_SIZE", 1 << 40)
+    expected = [pickle.dumps([s, s], protocol) for s in test_cases]
+    monkeypatch.setattr(pickle._Framer, "_LARGE_CHUNK_SIZE", 4096)
+    for s, data in zip(test_cases, expected):
+        assert pickle.dumps([s, s], protocol) == data
+        assert pickle.loads(data) == [s, s]
+
+# Test of the unpickler resource budgets
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_load_budgets(protocol):
+    """Test that an Unpickler stops at the resource budgets it was given"""
+    def load(data, **kwargs):
+        return pickle.Unpickler(io.BytesIO(data), **kwargs).load()
+
+    nested = []
+    for _ in range(100):
+        nested = [nested]
+    obj = {"text": ['中文字符' * 1000] * 3, "words": [str(i) for i in range(100)],
+           "nested": nested}
+    data = pickle.dumps(obj, protocol)
+    assert load(data, max_frame_size=1 << 20, max_memo_entries=1000,
+                max_stack_depth=1000, max_bytes_length=1 << 20,
+                max_total_bytes=1 << 20) == obj
+    with pytest.raises(pickle.MemoTooLargeError):
+        load(data, max_memo_entries=50)
+    with pytest.raises(pickle.StackTooDeepError):
+        load(data, max_stack_depth=50)
+    with pytest.raises(pickle.PayloadTooLargeError):
+        load(data, max_bytes_length=1000)
+    if protocol == 0:
+        with pytest.raises(pickle.AllocationBudgetError):
+            load(data, max_total_bytes=10000)
+    if protocol == -1 or protocol >= 4:
+        with pytest.raises(pickle.FrameTooLargeError):
+            load(data, max_frame_size=1000)
+        with pytest.raises(pickle.AllocationBudgetError):
+            load(data, max_total_bytes=10000)
+
+    # Declared sizes are rejected before anything is read
+    hostile = [b'\x80\x04\x95' + struct.pack('<Q', 1 << 40),
+               b'\x80\x04\x8e' + struct.pack('<Q', 1 << 40),
+               b'B' + struct.pack('<I', 1 << 30),
+               b'\x80\x02\x8b' + struct.pack('<i', 200 << 20),
+               b'V' + b'x' * 100000 + b'\n.',
+               b'C\xff' + b'x' * 255 + b'.',
+               b'\x8c\xff' + b'x' * 255 + b'.',
+               b'U\xff' + b'x' * 255 + b'.']
+    for data, kwargs, error in zip(
+            hostile, [{"max_frame_size": 1 << 20}, {"max_bytes_length": 1 << 20},
+                      {"max_total_bytes": 1 << 20}, {"max_bytes_length": 1000},
+                      {"max_bytes_length": 1000}, {"max_bytes_length": 100},
+                      {"max_bytes_length": 100}, {"max_bytes_length": 100}],
+            [pickle.FrameTooLargeError, pickle.PayloadTooLargeError,
+             pickle.AllocationBudgetError, pickle.PayloadTooLargeError,
+             pickle.PayloadTooLargeError, pickle.PayloadTooLargeError,
+             pickle.PayloadTooLargeError, pickle.PayloadTooLargeError]):
+        with pytest.raises(error):
+            load(data, **kwargs)
+        with pytest.raises(pickle.UnpicklingBudgetError):
+            load(data, readahead=2, **kwargs)
+    with pytest.raises(ValueError):
+        pickle.Unpickler(io.BytesIO(b''), max_memo_entries=-1)
+
+    # Many short payloads add up against the total budget as well
+    if protocol == -1 or protocol >= 3:
+        data = pickle.dumps([bytes([i % 256]) * 255 for i in range(2000)],
+                            protocol)
+        with pytest.raises(pickle.AllocationBudgetError):
+            load(data, max_total_bytes=100000)
+        assert len(load(data, max_total_bytes=1 << 21)) == 2000
+
+# Test of the opcode scanner and stream statistics
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_scan_opcodes(protocol):
+    """Test the opcode scanner and stream statistics against pickletools"""
+    obj = {"list": [1, -2, 3.5, 10 ** 30, 'x' * 300, b'y' * (70 * 1024)],
+           "date": datetime(2020, 1, 1), "set": {1, 2}, "none": None}
+    data = pickle.dumps([obj, obj], protocol) * 2
+    scanned = list(pickle.scan_opcodes(io.BytesIO(data)))
+    expected = []
+    for start in (0, len(data) // 2):
+        expected += [(op.name, start + pos) for op, arg, pos
+                     in pickletools.genops(data[start:])]
+    assert [(name, offset) for name, arg, offset in scanned] == expected
+
+    stats = pickle.pickle_stats(io.BytesIO(data), top=3)
+    assert stats["pickles"] == 2
+    assert stats["size"] == len(data)
+    assert sum(stats["opcodes"].values()) == len(expected)
+    assert ("datetime", "datetime") in stats["globals"]
+    if protocol != 0:
+        assert len(stats["payloads"]) == 3
+    if protocol == -1 or protocol >= 3:
+        assert stats["payloads"][0][0] == 70 * 1024
+    if protocol == -1 or protocol >= 4:
+        assert stats["frames"]["count"] > 0
+
+    with pytest.raises(pickle.UnpicklingError):
+        list(pickle.scan_opcodes(io.BytesIO(data[:len(data) // 4])))
+    with pytest.raises(pickle.UnpicklingError):
+        list(pickle.scan_opcodes(io.BytesIO(b'\xff')))
+
+# Test of the stream transcoder
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_transcode(protocol):
+    """Test rewriting pickles as protocol 5 without loading them"""
+    shared = [1, 2]
+    obj = {"ints": [0, 255, 65535, -1, 2 ** 31, -2 ** 200], "flags": [True, False],
+           "float": 1.25, "text": ['é\n\\', 'x' * 70000], "bytes": b'y' * 70000,
+           "shared": [shared, shared], "date": datetime(2020, 1, 1), "set": {1}}
+    data = pickle.dumps(obj, protocol) * 2
+    out = io.BytesIO()
+    pickle.transcode(io.BytesIO(data), out)
+    out.seek(0)
+    assert out.read(2) == b'\x80\x05'
+    out.seek(0)
+    assert pickle.load(out) == obj
+    assert pickle.load(out) == obj
+    assert out.read() == b''
+    text_ops = {"INT", "LONG", "FLOAT", "STRING", "UNICODE", "GET", "PUT", "GLOBAL"}
+    assert not text_ops & {op.name for op, arg, pos
+                           in pickletools.genops(out.getvalue())}
+
+    # Python 2 strings keep being decoded with the Unpickler's encoding
+    py2 = b"(S'caf\\xe9'\np0\ng0\nc__builtin__\nset\n(tR."
+    out = io.BytesIO()
+    pickle.transcode(io.BytesIO(py2), out)
+    for encoding in ("latin1", "bytes"):
+        assert (pickle.loads(out.getvalue(), encoding=encoding) ==
+                pickle.loads(py2, encoding=encoding))
+
+    # A memo index that is put again refers to the new object from then on
+    reput = b"(Va\np0\nVb\np0\nVc\np1\ng0\ng1\nl."
+    out = io.BytesIO()
+    pickle.transcode(io.BytesIO(reput), out)
+    assert pickle.loads(out.getvalue()) == ['a', 'b', 'c', 'b', 'c']
+    assert pickle.loads(reput) == ['a', 'b', 'c', 'b', 'c']
+
+    for refused in [b"\x80\x02cdatetime\ndatetime.now\n.", b"\x80\x02h\x05.",
+                    b"\x80\x02\x93."]:
+        with pytest.raises(pickle.UnpicklingError):
+            pickle.transcode(io.BytesIO(refused), io.BytesIO())
+
+# Enumeration used by the stdlib types test
+class Color(Enum):
+    RED = 1
+    BLUE = "blue"
+
+# Test of the dispatch entries for stdlib types
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_save_stdlib_types(protocol):
+    """Test that the dispatch entries of stdlib types match their reduce path"""
+    class ReducingPickler(pickle.Pickler):
+        def reducer_override(self, obj):
+            if type(obj) in fast or isinstance(obj, Enum):
+                return copyreg.dispatch_table.get(type(obj), type(obj).__reduce_ex__)(
+                    obj, *([self.proto] if type(obj) is not complex else []))
+            return NotImplemented
+
+    def dumps(obj, pickler=pickle.Pickler):
+        f = io.BytesIO()
+        pickler(f, protocol).dump(obj)
+        return f.getvalue()
+
+    fast = {datetime, date, time, timedelta, complex, range, slice,
+            collections.deque, decimal.Decimal}
+    tz = timezone(timedelta(hours=2))
+    items = [datetime(2020, 1, 2, 3, 4, 5, 6), datetime(2020, 1, 2, tzinfo=tz),
+             date(2020, 1, 2), time(1, 2), time(1, 2, tzinfo=tz), timedelta(3, 4, 5),
+             1 + 2j, range(1, 10, 2), slice(1, None, "x"), collections.deque([1, [2]]),
+             collections.deque([1], 5), decimal.Decimal("1.5"), Color.RED, Color.BLUE]
+    recursive = [1]
+    recursive.append(slice(recursive, None))
+    # Enough objects to cross frame boundaries at many offsets
+    obj = [items, items[:], recursive, "x" * 65000,
+           [datetime(2020, 1, 1) + timedelta(seconds=i) for i in range(10000)]]
+    data = dumps(obj)
+    assert data == dumps(obj, ReducingPickler)
+
+    class PersistentPickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            return None
+    assert data == dumps(obj, PersistentPickler)
+    loaded = pickle.loads(data)
+    assert loaded[:2] == [items, items] and loaded[3:] == obj[3:]
+    assert loaded[2][1].start is loaded[2]
+
+    # A dispatch_table entry still takes precedence
+    class TablePickler(pickle.Pickler):
+        dispatch_table = {complex: lambda c: (complex, (str(c),)),
+                          date: lambda d: (date.fromordinal, (d.toordinal(),))}
+    data = dumps([1 + 2j, date(2020, 1, 2)], TablePickler)
+    assert b"(1+2j)" in data and b"fromordinal" in data
+    assert pickle.loads(data) == [1 + 2j, date(2020, 1, 2)]
+
+# Test of arrays and memoryviews
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_save_array_memoryview(protocol):
+    """Test arrays and memoryviews written straight from their buffers"""
+    class ReducingPickler(pickle.Pickler):
+        def reducer_override(self, obj):
+            if type(obj) is array.array:
+                return obj.__reduce_ex__(self.proto)
+            return NotImplemented
+
+    def dumps(obj, pickler=pickle.Pickler):
+        f = io.BytesIO()
+        pickler(f, protocol).dump(obj)
+        return f.getvalue()
+
+    arrays = [array.array('i', range(10)), array.array('d', [1.5, 2]),
+              array.array('u', 'héllo'), array.array('b'),
+              array.array('Q', range(20000))]
+    data = dumps([arrays, arrays])
+    loaded = pickle.loads(data)
+    assert loaded == [arrays, arrays] and loaded[0] is loaded[1]
+    # The reduce value is kept, with its machine format code, without
+    # copying the items to bytes first
+    assert data == dumps([arrays, arrays], ReducingPickler)
+    for empty in ([array.array('i'), array.array('d')], [b'', array.array('i')]):
+        assert dumps(empty) == dumps(empty, ReducingPickler)
+
+    views = [memoryview(b'abc'), memoryview(bytearray(b'xyz')), memoryview(b''),
+             memoryview(array.array('i', range(12))).cast('B').cast('i', (3, 4)),
+             memoryview(bytearray(range(10)))[::2], memoryview(b'abcd').cast('i', ())]
+    for view, copy in zip(views, pickle.loads(dumps(views))):
+        assert copy.tolist() == view.tolist()
+        assert (copy.format, copy.shape, copy.readonly) == (view.format, view.shape,
+                                                              view.readonly)
+    with pytest.raises(pickle.PicklingError):
+        dumps(memoryview(array.array('u', 'ab')))
+
+# Test of in-band PickleBuffers
+def test_save_picklebuffer(buffer_pickle):
+    """Test that in-band PickleBuffers are written as by the stdlib pickle"""
+    readonly = buffer_pickle.PickleBuffer(b'abc' * 100)
+    writable = buffer_pickle.PickleBuffer(bytearray(b'xyz'))
+    large = buffer_pickle.PickleBuffer(b'x' * (200 * 1024))
+    for obj in ([readonly, writable, large], [readonly, readonly, writable, writable],
+                [b'abc', large, large]):
+        data = buffer_pickle._dumps(obj, 5)
+        assert data == buffer_pickle.dumps(obj, 5)
+        loaded = buffer_pickle._loads(data)
+        assert list(map(bytes, loaded)) == [bytes(memoryview(buf)) for buf in obj]
+    with pytest.raises(buffer_pickle.PicklingError):
+        buffer_pickle._dumps(readonly, 4)
+
+# Test of arrays sent out-of-band
+@pytest.mark.skipif(sys.byteorder != "little", reason="little-endian hosts only")
+def test_save_array_buffers(buffer_pickle):
+    """Test that arrays go out-of-band with protocol 5 and a buffer_callback"""
+    big = array.array('d', range(100000))
+    buffers = []
+    data = buffer_pickle._dumps(big, 5, buffer_callback=buffers.append)
+    assert len(buffers) == 1 and len(data) < 100
+    loaded = buffer_pickle._loads(data, buffers=buffers)
+    assert loaded == big and loaded.typecode == 'd'
+    data = buffer_pickle._dumps(big, 5, buffer_callback=lambda buf: True)
+    assert buffer_pickle._loads(data) == big
+
+    # Items whose size depends on the platform keep the reduce value, with
+    # its machine format code, and so does a pickler without a callback
+    for obj in (array.array('l', range(10)), array.array('L', range(10))):
+        buffers = []
+        data = buffer_pickle._dumps(obj, 5, buffer_callback=buffers.append)
+        assert not buffers and buffer_pickle._loads(data) == obj
+    assert buffer_pickle._dumps(big, 5) == pickle.dumps(big, 5)
+
+# Test of huge ints
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_save_huge_int(protocol):
+    """Test huge ints past the limit of int() and repr() on decimal text"""
+    limit = getattr(sys, "get_int_max_str_digits", lambda: 0)()
+    if limit:
+        sys.set_int_max_str_digits(640)
+    try:
+        values = [7 ** 20000, -(3 ** 5000) + 1, 2 ** 1992, -(2 ** 1991)]
+        data = pickle.dumps(values, protocol)
+        assert pickle.loads(data) == values
+        out = io.BytesIO()
+        pickle.transcode(io.BytesIO(data), out)
+        assert pickle.loads(out.getvalue()) == values
+        for x in values:
+            assert pickle.decode_decimal(pickle.encode_decimal(x)) == x
+    finally:
+        if limit:
+            sys.set_int_max_str_digits(limit)
+    assert pickle.encode_decimal(-7 ** 2000) == repr(-7 ** 2000).encode()
+    assert pickle.decode_decimal(b"  +" + b"9" * 1000 + b"\n") == 10 ** 1000 - 1
+    with pytest.raises(ValueError):
+        pickle.decode_decimal(b"0" * 1000 + b"1")
+
+# Test of the text protocols
+def test_text_protocols():
+    """Test protocol 0 text opcodes and streams that switch to frames"""
+    text = "a\\b\0c\nd\re\x1af é ☃"
+    # Escaped strings are memoized as their escaped copy, so they repeat
+    line = b"Va\\u005cb\\u0000c\\u000ad\\u000de\\u001af \xe9 \\u2603\n"
+    assert pickle.dumps([text, text, 7], 0) == (
+        b"(lp0\n" + line + b"p1\na" + line + b"p2\naI7\na.")
+    obj = {"text": [text] * 3, "n": list(range(-3, 300)), "big": 10 ** 40}
+    f = io.BytesIO()
+    for protocol in (0, 5, 1, 4, 0):
+        pickle.dump(obj, f, protocol)
+    f.seek(0)
+    unpickler = pickle.Unpickler(f)
+    for _ in range(5):
+        assert unpickler.load() == obj
+    with pytest.raises(EOFError):
+        unpickler.load()
+
+# Test of the specialized picklers
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_specialized_pickler(protocol):
+    """Test that specialized picklers write the same bytes as Pickler"""
+    cls = pickle.specialized_pickler(protocol)
+    assert cls is pickle.specialized_pickler(protocol)
+    assert cls is not pickle.specialized_pickler(protocol, fix_imports=False)
+    shared = ["shared"]
+    obj = [None, True, False, 0, 255, 65535, -1, 2 ** 31, 2 ** 70, 1.5, "",
+           "a\nb\\", "é" * 300, "x" * 70000, b"", b"b" * 300, b"c" * 70000,
+           (), (1,), (1, 2, 3), tuple(range(10)), shared, shared,
+           {"k": shared}, {i: str(i) for i in range(1500)},
+           list(range(2500)), datetime(2024, 1, 1), Color.RED, {1, 2}]
+    recursive = [obj]
+    recursive.append((recursive, recursive, recursive, recursive))
+    for value in (obj, recursive):
+        expected = io.BytesIO()
+        pickle.Pickler(expected, protocol).dump(value)
+        f = io.BytesIO()
+        pickler = cls(f)
+        pickler.dump(value)
+        assert f.getvalue() == expected.getvalue()
+        assert "save" not in vars(pickler)
+
+    class PersistentPickler(cls):
+        def persistent_id(self, obj):
+            return "pid" if obj is shared else None
+
+    f = io.BytesIO()
+    PersistentPickler(f).dump(obj)
+    loaded = pickle.Unpickler(io.BytesIO(f.getvalue()))
+    loaded.persistent_load = lambda pid: pid
+    assert loaded.load()[21] == "pid"
+    with pytest.raises(ValueError):
+        pickle.specialized_pickler(pickle.HIGHEST_PROTOCOL + 1)
+
+    # Small messages through one instance reuse its specialized save()
+    message = {"id": 7, "name": "sensor", "values": [1.5, 2.5], "ok": True}
+    expected, f = io.BytesIO(), io.BytesIO()
+    plain, pickler = pickle.Pickler(expected, protocol), cls(f)
+    builds = []
+    for change in (None, "clear_memo", "memo", "fast"):
+        if change == "clear_memo":
+            plain.clear_memo()
+            pickler.clear_memo()
+        elif change == "memo":
+            plain.memo = {}
+            pickler.memo = {}
+        elif change == "fast":
+            plain.fast = pickler.fast = 1
+        for _ in range(2):
+            plain.dump(message)
+            pickler.dump(message)
+            builds.append(pickler._specialized[3])
+    assert f.getvalue() == expected.getvalue()
+    assert builds[0] is builds[3] and len(set(map(id, builds))) == 3
+
+# Test of the protocol sweep
+def test_dumps_all_protocols():
+    """Test that one walk for all protocols matches dumps() for each"""
+    shared = ["shared", "a\nb"]
+    obj = [None, True, 0, 300, -1, 2 ** 40, 1.5, "é" * 300, "x" * 70000,
+           b"b" * 300, b"c" * 70000, (), (1,), (shared,) * 5, shared,
+           {i: str(i) for i in range(1500)}, list(range(2500)),
+           datetime(2024, 1, 1), Color.RED, {1, 2}, bytearray(b"ab")]
+    obj.append((obj, obj))
+    results = pickle.dumps_all_protocols(obj)
+    assert list(results) == list(range(pickle.HIGHEST_PROTOCOL + 1))
+    for protocol, data in results.items():
+        assert data == pickle.dumps(obj, protocol)
+    digests = pickle.dumps_all_protocols(obj, [5, -1, 2], digest="sha256")
+    assert digests == {
+        5: hashlib.sha256(results[5]).hexdigest(),
+        2: hashlib.sha256(results[2]).hexdigest()}
+    with pytest.raises(ValueError):
+        pickle.dumps_all_protocols(obj, [pickle.HIGHEST_PROTOCOL + 1])
+    with pytest.raises(pickle.PicklingError):
+        pickle.dumps_all_protocols([lambda: None])
+
+# Object graph node used by the roundtrip test
+class Node:
+    def __init__(self, value):
+        self.value = value
+        self.children = [self]
+
+# Test of roundtrip()
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_roundtrip(protocol):
+    """Test that roundtrip() builds what loads(dumps()) builds"""
+    shared = [1.5, "a\nb", b"b" * 300]
+    node = Node(shared)
+    obj = [None, True, 2 ** 70, "é" * 300, bytearray(b"ab"), (), (shared,),
+           tuple(range(10)), {i: str(i) for i in range(1500)},
+           list(range(2500)), datetime(2024, 1, 1), Color.RED, {1, 2},
+           frozenset({3}), node, shared, pickle.Pickler]
+    obj.append((obj, obj))
+    copy = pickle.roundtrip(obj, protocol)
+    assert copy is not obj and copy[15] is not shared
+    loaded = pickle.loads(pickle.dumps(obj, protocol))
+    assert copy[:14] + copy[15:-1] == loaded[:14] + loaded[15:-1]
+    assert copy[-1] == (copy, copy)
+    assert copy[6][0] is copy[15] is copy[14].value
+    assert copy[14].children[0] is copy[14]
+    assert copy[4] == obj[4] and copy[4] is not obj[4]
+    with pytest.raises(pickle.PicklingError):
+        pickle.roundtrip([lambda: None], protocol)
+
+# Test of the shared dictionaries
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_shared_dictionary(protocol):
+    """Test pickles that refer to the entries of a shared dictionary"""
+    messages = [{"kind": "node", "node": Node("value-%d" % (i % 3)),
+                 "when": datetime(2024, 1, 1 + i), "tags": ["a", "shared"]}
+                for i in range(20)]
+    dictionary = pickle.SharedDictionary.train(messages[:10], version=3,
+                                               protocol=protocol)
+    assert Node in dictionary.objects and "shared" in dictionary.objects
+    assert "a" not in dictionary.objects and "value-0" in dictionary.objects
+    dictionary = pickle.loads(pickle.dumps(dictionary, protocol))
+    assert dictionary.version == 3 and dictionary.index(Node) is not None
+
+    f = io.BytesIO()
+    pickler = pickle.SharedDictionaryPickler(f, dictionary, protocol)
+    for message in messages:
+        pickler.clear_memo()
+        pickler.dump(message)
+    assert len(f.getvalue()) < sum(
+        len(pickle.dumps(message, protocol)) for message in messages) * 0.7
+    f.seek(0)
+    unpickler = pickle.SharedDictionaryUnpickler(f, dictionary)
+    for message in messages:
+        loaded = unpickler.load()
+        assert type(loaded["node"]) is Node
+        assert loaded["node"].value == message["node"].value
+        assert loaded["when"] == message["when"]
+        assert loaded["tags"] == ["a", "shared"]
+
+    data = f.getvalue()
+    with pytest.raises(pickle.UnpicklingError, match="version 3"):
+        pickle.SharedDictionaryUnpickler(
+            io.BytesIO(data), pickle.SharedDictionary(dictionary.objects)).load()
+    with pytest.raises(pickle.UnpicklingError, match="no entry"):
+        pickle.SharedDictionaryUnpickler(
+            io.BytesIO(data), pickle.SharedDictionary((), 3)).load()
+    unpickler = pickle.SharedDictionaryUnpickler(io.BytesIO(), dictionary)
+    with pytest.raises(pickle.UnpicklingError, match="without a version"):
+        unpickler.persistent_load(0 if protocol else "0")
+
+# Test of the session picklers
+@pytest.mark.parametrize("protocol", range(-1, 6))
+def test_session(protocol):
+    """Test message streams that keep the memo between messages"""
+    users = [Node("user-%d" % i) for i in range(30)]
+    config = {"hosts": ["a", "b"], "timeout": 1.5}
+    messages = [{"user": users[i * 7 % 30], "config": config,
+                 "at": datetime(2024, 1, 1, 0, 0, i % 60)}
+                for i in range(100)]
+    sizes = {}
+    for memo_size in (None, 0, 20):
+        f = io.BytesIO()
+        pickler = pickle.SessionPickler(f, protocol, memo_size=memo_size)
+        for message in messages:
+            pickler.dump(message)
+        if memo_size is not None:
+            assert len(pickler.memo) <= memo_size
+        sizes[memo_size] = len(f.getvalue())
+        f.seek(0)
+        unpickler = pickle.SessionUnpickler(f, memo_size=memo_size)
+        loaded = [unpickler.load() for _ in messages]
+        for message, copy in zip(messages, loaded):
+            assert copy["user"].value == message["user"].value
+            assert copy["config"] == config and copy["at"] == message["at"]
+        if memo_size is None:
+            assert loaded[0]["config"] is loaded[-1]["config"]
+            assert loaded[0]["user"] is loaded[30]["user"]
+        assert len(unpickler.memo) == len(pickler.memo)
+        with pytest.raises(EOFError):
+            unpickler.load()
+    assert sizes[0] == sum(len(pickle.dumps(m, protocol)) for m in messages)
+    assert sizes[None] < sizes[20] < sizes[0]
+
+# Test of the extension registries
+def test_extension_registry(tmp_path):
+    """Test extension codes assigned to the globals of sample data"""
+    samples = [[Node(i), Color.RED, datetime(2024, 1, 1)] for i in range(5)]
+    registry = pickle.ExtensionRegistry.train(samples + [[len]])
+    assert registry.codes == {(Node.__module__, "Node"): 240,
+                              (Color.__module__, "Color"): 241,
+                              ("datetime", "datetime"): 242}
+    path = tmp_path / "registry.json"
+    registry.save(path)
+    registry = pickle.ExtensionRegistry.load(path)
+    assert len(registry) == 3 and registry.version == 1
+
+    updated = pickle.ExtensionRegistry.train(
+        [[len, print]] * 2 + samples[:2], registry, start=241)
+    assert updated.version == 2
+    assert updated.codes == {**registry.codes, ("builtins", "len"): 243,
+                             ("builtins", "print"): 244}
+    assert pickle.ExtensionRegistry.train(samples, updated).version == 2
+
+    before = [pickle.dumps(sample, protocol) for sample in samples
+              for protocol in range(6)]
+    updated.install()
+    try:
+        updated.install()
+        after = [pickle.dumps(sample, protocol) for sample in samples
+                 for protocol in range(6)]
+        for old, new in zip(before, after):
+            assert len(new) <= len(old)
+            loaded = pickle.loads(new)
+            assert type(loaded[0]) is Node and loaded[1] is Color.RED
+        assert sum(map(len, after)) < sum(map(len, before)) * 0.9
+    finally:
+        updated.uninstall()
+    assert ("builtins", "len") not in copyreg._extension_registry
+
+    path.write_text('{"format": 99}')
+    with pytest.raises(ValueError):
+        pickle.ExtensionRegistry.load(path)
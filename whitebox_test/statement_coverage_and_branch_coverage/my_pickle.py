@@ -7,6 +7,12 @@ Classes:
 
     Pickler
     Unpickler
+    SharedDictionary
+    SharedDictionaryPickler
+    SharedDictionaryUnpickler
+    SessionPickler
+    SessionUnpickler
+    ExtensionRegistry
 
 Functions:
 
@@ -14,6 +20,18 @@ Functions:
     dumps(object) -> string
     load(file) -> object
     loads(bytes) -> object
+    dump_async(object, writer)
+    load_async(reader) -> object
+    dumps_shared(object) -> (bytes, segment)
+    loads_shared(bytes, segment) -> object
+    dump_with_sidecar(object, path)
+    load_with_sidecar(path) -> object
+    scan_opcodes(file) -> iterator of (name, arg, offset)
+    pickle_stats(file) -> dict
+    transcode(infile, outfile)
+    specialized_pickler(protocol) -> Pickler subclass
+    dumps_all_protocols(object) -> dict of strings
+    roundtrip(object) -> object
 
 Misc variables:
 
@@ -23,21 +41,36 @@ Misc variables:
 
 """
 
-from types import FunctionType
+from types import FunctionType, BuiltinFunctionType
 from copyreg import dispatch_table
 from copyreg import _extension_registry, _inverted_registry, _extension_cache
 from itertools import islice
 from functools import partial
+from weakref import WeakKeyDictionary
+from collections import deque
+from array import array
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, localcontext, Inexact, MAX_PREC, MAX_EMAX
+from enum import Enum, EnumMeta
 import sys
 from sys import maxsize
-from struct import pack, unpack
+from struct import Struct, pack, unpack, calcsize, iter_unpack
 import re
 import io
 import codecs
 import _compat_pickle
 
-__all__ = ["PickleError", "PicklingError", "UnpicklingError", "Pickler",
-           "Unpickler", "dump", "dumps", "load", "loads"]
+__all__ = ["PickleError", "PicklingError", "UnpicklingError",
+           "UnpicklingBudgetError", "FrameTooLargeError", "MemoTooLargeError",
+           "StackTooDeepError", "PayloadTooLargeError",
+           "AllocationBudgetError", "Pickler",
+           "Unpickler", "dump", "dumps", "load", "loads", "dump_async",
+           "load_async", "dumps_shared", "loads_shared", "dump_with_sidecar",
+           "load_with_sidecar", "scan_opcodes", "pickle_stats", "transcode",
+           "specialized_pickler", "dumps_all_protocols", "roundtrip",
+           "SharedDictionary", "SharedDictionaryPickler",
+           "SharedDictionaryUnpickler", "SessionPickler",
+           "SessionUnpickler", "ExtensionRegistry"]
 
 try:
     from _pickle import PickleBuffer
@@ -92,6 +125,33 @@ class UnpicklingError(PickleError):
     """
     pass
 
+class UnpicklingBudgetError(UnpicklingError):
+    """A common base class for the errors raised when an Unpickler exceeds
+    one of the resource budgets it was given.
+
+    """
+    pass
+
+class FrameTooLargeError(UnpicklingBudgetError):
+    """A frame is larger than *max_frame_size*."""
+    pass
+
+class MemoTooLargeError(UnpicklingBudgetError):
+    """The memo holds more than *max_memo_entries* objects."""
+    pass
+
+class StackTooDeepError(UnpicklingBudgetError):
+    """The stack holds more than *max_stack_depth* objects."""
+    pass
+
+class PayloadTooLargeError(UnpicklingBudgetError):
+    """A bytes, bytearray or str payload is longer than *max_bytes_length*."""
+    pass
+
+class AllocationBudgetError(UnpicklingBudgetError):
+    """Frames and payloads add up to more than *max_total_bytes*."""
+    pass
+
 # An instance of _Stop is raised by Unpickler.load_stop() in response to
 # the STOP opcode, passing the object that is the result of unpickling.
 class _Stop(Exception):
@@ -196,18 +256,47 @@ READONLY_BUFFER  = b'\x98'  # make top of stack readonly
 
 __all__.extend([x for x in dir() if re.match("[A-Z][A-Z0-9_]+$", x)])
 
+# Headers of the opcodes that take a one-byte argument, indexed by that
+# argument, and packers of the opcodes with wider arguments.  They spare the
+# hot save paths a pack() call and a concatenation per opcode.
+_PROTO_HEADERS = [PROTO + bytes([i]) for i in range(256)]
+_BININT1_HEADERS = [BININT1 + bytes([i]) for i in range(256)]
+_BINGET_HEADERS = [BINGET + bytes([i]) for i in range(256)]
+_BINPUT_HEADERS = [BINPUT + bytes([i]) for i in range(256)]
+_SHORT_BINSTRING_HEADERS = [SHORT_BINSTRING + bytes([i]) for i in range(256)]
+_SHORT_BINBYTES_HEADERS = [SHORT_BINBYTES + bytes([i]) for i in range(256)]
+_SHORT_BINUNICODE_HEADERS = [SHORT_BINUNICODE + bytes([i])
+                             for i in range(256)]
+_LONG1_HEADERS = [LONG1 + bytes([i]) for i in range(256)]
+_EXT1_HEADERS = [EXT1 + bytes([i]) for i in range(256)]
+_pack_op_H = Struct("<cH").pack
+_pack_op_i = Struct("<ci").pack
+_pack_op_I = Struct("<cI").pack
+_pack_op_Q = Struct("<cQ").pack
+_pack_op_d = Struct(">cd").pack
+# Templates of the protocol 0 opcodes with a decimal argument
+_INT_TEXT = INT + b'%d\n'
+_GET_TEXT = GET + b'%d\n'
+_PUT_TEXT = PUT + b'%d\n'
+
 
 class _Framer:
 
     _FRAME_SIZE_MIN = 4
     _FRAME_SIZE_TARGET = 64 * 1024
+    _LARGE_CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, file_write):
         self.file_write = file_write
         self.current_frame = None
+        self.framed = True
 
-    def start_framing(self):
+    def start_framing(self, framed=True):
+        # With framed=False (protocols 0 to 3) output is still collected in
+        # frame-sized chunks, but they are written without a FRAME opcode
+        # so that the stream is unchanged.
         self.current_frame = io.BytesIO()
+        self.framed = framed
 
     def end_framing(self):
         if self.current_frame and self.current_frame.tell() > 0:
@@ -220,12 +309,12 @@ class _Framer:
             if f.tell() >= self._FRAME_SIZE_TARGET or force:
                 data = f.getbuffer()
                 write = self.file_write
-                if len(data) >= self._FRAME_SIZE_MIN:
+                if self.framed and len(data) >= self._FRAME_SIZE_MIN:
                     # Issue a single call to the write method of the underlying
                     # file object for the frame opcode with the size of the
                     # frame. The concatenation is expected to be less expensive
                     # than issuing an additional call to write.
-                    write(FRAME + pack("<Q", len(data)))
+                    write(_pack_op_Q(FRAME, len(data)))
 
                 # Issue a separate call to write to append the frame
                 # contents without concatenation to the above to avoid a
@@ -259,12 +348,81 @@ class _Framer:
         write(header)
         write(payload)
 
+    def write_large_chunks(self, header, chunks):
+        # Same as write_large_bytes(), with the payload given as an iterable
+        # of chunks so that it never needs to exist in one piece.
+        write = self.file_write
+        if self.current_frame:
+            self.commit_frame(force=True)
+        write(header)
+        for chunk in chunks:
+            write(chunk)
+
+
+class _WriteBehind:
+
+    # Write method installed on the _Framer when the pickler has
+    # *writebehind* set.  Committed frames and large payloads are queued, in
+    # order, for a writer thread so that encoding of the next frame goes on
+    # while the OS write runs.  The first error hit by the thread is raised
+    # by the next write(), or else returned by close().  It is kept without
+    # its traceback, whose frames would hold views of the framer's buffers
+    # for as long as the error is alive.
+
+    def __init__(self, file_write, depth):
+        import queue
+        import threading
+        self.file_write = file_write
+        self.queue = queue.Queue(depth)
+        self.failed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if self.failed:
+            error = self.error
+            self.error = None
+            if error is None:
+                raise OSError("writebehind thread failed to write")
+            try:
+                raise error
+            finally:
+                error = None
+        self.queue.put(data)
+        return len(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        error = self.error
+        self.error = None
+        return error
+
+    def _run(self):
+        get = self.queue.get
+        write = self.file_write
+        while True:
+            data = get()
+            if data is None:
+                return
+            if not self.failed:
+                try:
+                    write(data)
+                except BaseException as exc:
+                    self.error = exc.with_traceback(None)
+                    self.failed = True
+            data = None
+
 
 class _Unframer:
 
-    def __init__(self, file_read, file_readline, file_tell=None):
+    def __init__(self, file_read, file_readline, file_tell=None,
+                 file_readinto=None, file_readview=None):
         self.file_read = file_read
         self.file_readline = file_readline
+        self.file_readinto = file_readinto
+        self.file_readview = file_readview
         self.current_frame = None
 
     def readinto(self, buf):
@@ -272,17 +430,35 @@ class _Unframer:
             n = self.current_frame.readinto(buf)
             if n == 0 and len(buf) != 0:
                 self.current_frame = None
-                n = len(buf)
-                buf[:] = self.file_read(n)
-                return n
+                return self._file_readinto(buf)
             if n < len(buf):
                 raise UnpicklingError(
                     "pickle exhausted before end of frame")
             return n
         else:
+            return self._file_readinto(buf)
+
+    def _file_readinto(self, buf):
+        if self.file_readinto is None:
             n = len(buf)
             buf[:] = self.file_read(n)
             return n
+        # Raw files may fill only part of the buffer per call.
+        with memoryview(buf) as view, view.cast('B') as m:
+            n = 0
+            while n < len(m):
+                k = self.file_readinto(m[n:])
+                if not k:
+                    raise UnpicklingError("pickle data was truncated")
+                n += k
+        return n
+
+    def readview(self, n):
+        # Like read(), but data outside of a frame may be returned as a
+        # read-only memoryview when the file can provide one.
+        if self.current_frame or self.file_readview is None:
+            return self.read(n)
+        return self.file_readview(n)
 
     def read(self, n):
         if self.current_frame:
@@ -317,6 +493,336 @@ class _Unframer:
         self.current_frame = io.BytesIO(self.file_read(frame_size))
 
 
+class _MappedFile:
+
+    # File object over a read-only memory map of a regular file, used by
+    # _Unpickler when *use_mmap* is set.  read() slices the mapping instead
+    # of calling file.read(), readinto() copies straight from the mapping
+    # into the target buffer, and readview() returns a memoryview into the
+    # mapping so that large payloads are decoded without an intermediate
+    # bytes object.  close() moves the file position past the consumed data.
+
+    def __init__(self, file, map):
+        self.file = file
+        self.map = map
+        self.view = memoryview(map)
+        self.pos = file.tell()
+
+    @classmethod
+    def open(cls, file):
+        # Return None if file is not a non-empty regular file.
+        import mmap
+        import os
+        import stat
+        try:
+            fd = file.fileno()
+            st = os.fstat(fd)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return None
+        return cls(file, mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        self.file.seek(self.pos)
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Views handed out by readview() keep the mapping alive.
+            pass
+
+    def read(self, n):
+        pos = self.pos
+        self.pos = min(pos + n, len(self.map))
+        return self.map[pos:self.pos]
+
+    def readline(self):
+        end = self.map.find(b'\n', self.pos) + 1 or len(self.map)
+        pos = self.pos
+        self.pos = end
+        return self.map[pos:end]
+
+    def readinto(self, buf):
+        with memoryview(buf) as view, view.cast('B') as m:
+            n = min(len(m), len(self.map) - self.pos)
+            m[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def readview(self, n):
+        pos = self.pos
+        self.pos = min(pos + n, len(self.map))
+        return self.view[pos:self.pos]
+
+
+class _ReadBuffer:
+
+    # File object wrapper used by _Unpickler when *buffered* is enabled.
+    # Small reads, i.e. everything outside of frames and large payloads, are
+    # served from a chunk read ahead from the file instead of costing one
+    # file.read() call per opcode.  Bytes read past the end of a pickle are
+    # kept for the next load(), or returned to a seekable file by
+    # give_back().
+
+    _BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, file):
+        self.file = file
+        self.file_read = file.read
+        # read1() returns what a single read of the underlying raw stream
+        # gives, so a pipe or socket is never waited on for a full chunk.
+        self.file_read1 = getattr(file, 'read1', file.read)
+        self.file_readinto = getattr(file, 'readinto', None)
+        self.buffer = io.BytesIO()
+
+    @property
+    def remainder(self):
+        return self.buffer.getvalue()[self.buffer.tell():]
+
+    def give_back(self):
+        rest = self.remainder
+        if rest and _seekable(self.file):
+            self.file.seek(-len(rest), io.SEEK_CUR)
+            self.buffer = io.BytesIO()
+
+    def _fill(self):
+        chunk = self.file_read1(self._BUFFER_SIZE)
+        self.buffer = io.BytesIO(chunk)
+        return bool(chunk)
+
+    def _read_exactly(self, n):
+        # Raw files may return short reads before the end of the file.
+        pieces = []
+        while n:
+            data = self.file_read(n)
+            if not data:
+                break
+            pieces.append(data)
+            n -= len(data)
+        return b''.join(pieces)
+
+    def read(self, n):
+        data = self.buffer.read(n)
+        if len(data) == n:
+            return data
+        n -= len(data)
+        if n >= self._BUFFER_SIZE:
+            return data + self._read_exactly(n)
+        pieces = [data]
+        while n and self._fill():
+            data = self.buffer.read(n)
+            pieces.append(data)
+            n -= len(data)
+        return b''.join(pieces)
+
+    def readinto(self, buf):
+        with memoryview(buf) as view, view.cast('B') as m:
+            n = self.buffer.readinto(m)
+            if n == len(m) or len(m) - n >= self._BUFFER_SIZE:
+                if n < len(m) and self.file_readinto is not None:
+                    n += self.file_readinto(m[n:]) or 0
+                elif n < len(m):
+                    data = self._read_exactly(len(m) - n)
+                    m[n:n + len(data)] = data
+                    n += len(data)
+                return n
+            while n < len(m) and self._fill():
+                n += self.buffer.readinto(m[n:])
+        return n
+
+    def readline(self):
+        data = self.buffer.readline()
+        if data[-1:] == b'\n':
+            return data
+        pieces = [data]
+        while self._fill():
+            data = self.buffer.readline()
+            pieces.append(data)
+            if data[-1:] == b'\n':
+                break
+        return b''.join(pieces)
+
+
+class _ReadAhead:
+
+    # File object wrapper used by _Unpickler when *readahead* is set.  A
+    # background thread walks the frame structure of a protocol 4+ stream
+    # and reads up to *depth* frames ahead of the decoder.  It only parses
+    # what it can size without decoding: PROTO, FRAME and the unframed
+    # payloads written by _Framer.write_large_bytes().  On any other opcode
+    # it passes that byte on and stops, and the decoder reads the file
+    # directly until the next FRAME, where resume() restarts the thread.
+    # A frame ending in STOP also stops it, so that it never reads past the
+    # end of the pickle.  Frames and payloads larger than *limit* are left
+    # for the decoder to read, or to reject.
+
+    _SIZED = {BINBYTES[0]: ('<I', 4), BINUNICODE[0]: ('<I', 4),
+              BINBYTES8[0]: ('<Q', 8), BINUNICODE8[0]: ('<Q', 8),
+              BYTEARRAY8[0]: ('<Q', 8)}
+
+    def __init__(self, file_read, file_readline, depth, file_readinto=None,
+                 limit=maxsize):
+        import queue
+        self.file_read = file_read
+        self.file_readline = file_readline
+        self.file_readinto = file_readinto
+        self.limit = limit
+        self.queue = queue.Queue(depth)
+        self.chunks = deque()
+        self.pos = 0
+        self.last = b''
+        self.thread = None
+        self.running = False
+        self.closed = False
+        self.resume()
+
+    def resume(self):
+        if self.running or self.chunks or self.last == STOP:
+            return
+        import threading
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.closed = True
+        while self.running:
+            if self.queue.get() is None:
+                self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        read = self.file_read
+        put = self.queue.put
+        try:
+            while not self.closed:
+                op = read(1)
+                if not op:
+                    break
+                code = op[0]
+                if code == FRAME[0]:
+                    header = read(8)
+                    if len(header) < 8:
+                        put([op, header])
+                        break
+                    size, = unpack('<Q', header)
+                    if size > self.limit:
+                        put([op, header])
+                        break
+                    data = read(size)
+                    put([op + header, data])
+                    if len(data) < size or data[-1:] == STOP:
+                        break
+                elif code == PROTO[0]:
+                    put([op + read(1)])
+                elif code in self._SIZED:
+                    fmt, width = self._SIZED[code]
+                    header = read(width)
+                    if len(header) < width:
+                        put([op, header])
+                        break
+                    size, = unpack(fmt, header)
+                    if size > self.limit:
+                        put([op, header])
+                        break
+                    data = read(size)
+                    put([op + header, data])
+                    if len(data) < size:
+                        break
+                else:
+                    put([op])
+                    break
+        except BaseException as exc:
+            put(exc)
+        finally:
+            put(None)
+
+    def _fill(self):
+        # Take the next unit from the background thread; return False once
+        # it has stopped and everything it read has been consumed.
+        while self.running:
+            item = self.queue.get()
+            if item is None:
+                self.running = False
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                self.chunks.extend(chunk for chunk in item if chunk)
+                if self.chunks:
+                    return True
+        return False
+
+    def read(self, n):
+        chunks = self.chunks
+        if not chunks and not self._fill():
+            data = self.file_read(n)
+            self.last = data[-1:]
+            return data
+        if self.pos == 0 and len(chunks[0]) == n:
+            # A whole frame or payload, as the thread read it.
+            return chunks.popleft()
+        pieces = []
+        while n:
+            if not chunks and not self._fill():
+                data = self.file_read(n)
+                self.last = data[-1:]
+                pieces.append(data)
+                break
+            chunk = chunks[0]
+            end = self.pos + n
+            if end < len(chunk):
+                pieces.append(chunk[self.pos:end])
+                self.pos = end
+                break
+            pieces.append(chunk[self.pos:])
+            n = end - len(chunk)
+            chunks.popleft()
+            self.pos = 0
+        return b''.join(pieces)
+
+    def readinto(self, buf):
+        with memoryview(buf) as view, view.cast('B') as m:
+            if (self.file_readinto is not None and not self.chunks
+                    and not self._fill()):
+                n = self.file_readinto(m) or 0
+                self.last = bytes(m[n - 1:n])
+                return n
+            data = self.read(len(m))
+            m[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        chunks = self.chunks
+        pieces = []
+        while True:
+            if not chunks and not self._fill():
+                data = self.file_readline()
+                self.last = data[-1:]
+                pieces.append(data)
+                break
+            chunk = chunks[0]
+            end = chunk.find(b'\n', self.pos) + 1
+            if end:
+                pieces.append(chunk[self.pos:end])
+                self.pos = end
+                if end == len(chunk):
+                    chunks.popleft()
+                    self.pos = 0
+                break
+            pieces.append(chunk[self.pos:])
+            chunks.popleft()
+            self.pos = 0
+        return b''.join(pieces)
+
+
+def _seekable(file):
+    try:
+        return file.seekable()
+    except AttributeError:
+        return False
+
 # Tools used for pickling.
 
 def _getattribute(obj, name):
@@ -401,13 +907,114 @@ def decode_long(data):
     """
     return int.from_bytes(data, byteorder='little', signed=True)
 
+# Decimal text of ints is converted in chunks of at most this many digits
+# (or the matching number of bits), which int() and repr() accept whatever
+# sys.set_int_max_str_digits() was given (640 at least).
+_DECIMAL_CHUNK_DIGITS = 600
+_DECIMAL_CHUNK_BITS = 1992
+_DECIMAL_LITERAL = re.compile(rb"\s*([-+]?[1-9][0-9]*)\s*\Z")
+
+def encode_decimal(x):
+    r"""Encode an int as ASCII decimal digits, like repr(x).
+
+    Large ints are split in halves recursively and put together again with
+    decimal.Decimal arithmetic, which takes subquadratic time and is not
+    subject to the limit of sys.set_int_max_str_digits().
+
+    >>> encode_decimal(-255)
+    b'-255'
+    >>> encode_decimal(7 ** 5000) == repr(7 ** 5000).encode()
+    True
+    """
+    if x.bit_length() <= _DECIMAL_CHUNK_BITS:
+        return repr(x).encode("ascii")
+    with localcontext() as ctx:
+        ctx.prec = MAX_PREC
+        ctx.Emax = MAX_EMAX
+        ctx.traps[Inexact] = True
+        powers = {}
+
+        def pow2(w):
+            # Decimal 2 ** w, built from the powers already known
+            result = powers.get(w)
+            if result is None:
+                if w <= _DECIMAL_CHUNK_BITS:
+                    result = Decimal(2) ** w
+                elif w - 1 in powers:
+                    result = powers[w - 1] * 2
+                else:
+                    result = pow2(w >> 1) * pow2(w - (w >> 1))
+                powers[w] = result
+            return result
+
+        def convert(n, w):
+            # Decimal n, for 0 <= n < 2 ** w
+            if w <= _DECIMAL_CHUNK_BITS:
+                return Decimal(n)
+            w2 = w >> 1
+            hi = n >> w2
+            return convert(n - (hi << w2), w2) + convert(hi, w - w2) * pow2(w2)
+
+        result = str(convert(abs(x), x.bit_length()))
+    return (result if x > 0 else "-" + result).encode("ascii")
+
+def decode_decimal(data):
+    r"""Decode an int from ASCII text, like int(data, 0).
+
+    Long decimal numbers are split in halves recursively and put together
+    again with int arithmetic, which takes subquadratic time and is not
+    subject to the limit of sys.set_int_max_str_digits().
+
+    >>> decode_decimal(b'-255')
+    -255
+    >>> decode_decimal(b'0x10')
+    16
+    >>> decode_decimal(repr(7 ** 5000).encode()) == 7 ** 5000
+    True
+    """
+    if len(data) <= _DECIMAL_CHUNK_DIGITS:
+        return int(data, 0)
+    m = _DECIMAL_LITERAL.match(data)
+    if m is None:
+        return int(data, 0)
+    digits = m.group(1)
+    powers = {}
+
+    def pow5(w):
+        # 5 ** w, built from the powers already known
+        result = powers.get(w)
+        if result is None:
+            if w <= _DECIMAL_CHUNK_DIGITS:
+                result = 5 ** w
+            elif w - 1 in powers:
+                result = powers[w - 1] * 5
+            else:
+                result = pow5(w >> 1) * pow5(w - (w >> 1))
+            powers[w] = result
+        return result
+
+    def convert(a, b):
+        # int(digits[a:b]), as 10 ** w is 5 ** w << w
+        if b - a <= _DECIMAL_CHUNK_DIGITS:
+            return int(digits[a:b])
+        mid = (a + b + 1) >> 1
+        w = b - mid
+        return convert(mid, b) + ((convert(a, mid) * pow5(w)) << w)
+
+    start = 1 if digits[0] in b"+-" else 0
+    result = convert(start, len(digits))
+    return -result if digits[0] == b"-"[0] else result
+
 
 # Pickling machinery
 
+# The reducer copyreg registers for complex numbers
+_reduce_complex = dispatch_table.get(complex)
+
 class _Pickler:
 
     def __init__(self, file, protocol=None, *, fix_imports=True,
-                 buffer_callback=None):
+                 buffer_callback=None, writebehind=0):
         """This takes a binary file for writing a pickle data stream.
 
         The optional *protocol* argument tells the pickler to use the
@@ -440,6 +1047,12 @@ class _Pickler:
 
         It is an error if *buffer_callback* is not None and *protocol*
         is None or smaller than 5.
+
+        If *writebehind* is a positive integer, dump() hands committed
+        frames and large payloads to a writer thread through a queue of
+        at most *writebehind* entries and keeps encoding meanwhile.  Data
+        reaches *file* in the same order, and any error raised by its
+        write() method is re-raised before dump() returns.
         """
         if protocol is None:
             protocol = DEFAULT_PROTOCOL
@@ -449,7 +1062,10 @@ class _Pickler:
             raise ValueError("pickle protocol must be <= %d" % HIGHEST_PROTOCOL)
         if buffer_callback is not None and protocol < 5:
             raise ValueError("buffer_callback needs protocol >= 5")
+        if writebehind < 0:
+            raise ValueError("writebehind must be >= 0")
         self._buffer_callback = buffer_callback
+        self._writebehind = writebehind
         try:
             self._file_write = file.write
         except AttributeError:
@@ -457,11 +1073,13 @@ class _Pickler:
         self.framer = _Framer(self._file_write)
         self.write = self.framer.write
         self._write_large_bytes = self.framer.write_large_bytes
+        self._write_large_chunks = self.framer.write_large_chunks
         self.memo = {}
         self.proto = int(protocol)
         self.bin = protocol >= 1
         self.fast = 0
         self.fix_imports = fix_imports and protocol < 3
+        self._plain_saves = False
 
     def clear_memo(self):
         """Clears the pickler's "memo".
@@ -480,13 +1098,33 @@ class _Pickler:
         if not hasattr(self, "_file_write"):
             raise PicklingError("Pickler.__init__() was not called by "
                                 "%s.__init__()" % (self.__class__.__name__,))
-        if self.proto >= 2:
-            self.write(PROTO + pack("<B", self.proto))
-        if self.proto >= 4:
-            self.framer.start_framing()
-        self.save(obj)
-        self.write(STOP)
-        self.framer.end_framing()
+        writer = None
+        if self._writebehind:
+            writer = _WriteBehind(self._file_write, self._writebehind)
+            self.framer.file_write = writer.write
+        try:
+            if self.proto >= 2:
+                self.write(_PROTO_HEADERS[self.proto])
+            self.framer.start_framing(framed=self.proto >= 4)
+            # Without a persistent_id() or reducer_override() of its own,
+            # save() goes straight to the dispatch table for any object that
+            # is not memoized yet
+            self._plain_saves = (
+                getattr(self, "reducer_override", None) is None and
+                getattr(self.persistent_id, "__func__", None)
+                is _Pickler.persistent_id)
+            self.save(obj)
+            self.write(STOP)
+            self.framer.end_framing()
+        finally:
+            if writer is not None:
+                self.framer.file_write = self._file_write
+                error = writer.close()
+        if writer is not None and error is not None:
+            try:
+                raise error
+            finally:
+                error = None
 
     def memoize(self, obj):
         """Store an object in the memo."""
@@ -516,21 +1154,21 @@ class _Pickler:
             return MEMOIZE
         elif self.bin:
             if idx < 256:
-                return BINPUT + pack("<B", idx)
+                return _BINPUT_HEADERS[idx]
             else:
-                return LONG_BINPUT + pack("<I", idx)
+                return _pack_op_I(LONG_BINPUT, idx)
         else:
-            return PUT + repr(idx).encode("ascii") + b'\n'
+            return _PUT_TEXT % idx
 
     # Return a GET (BINGET, LONG_BINGET) opcode string, with argument i.
     def get(self, i):
         if self.bin:
             if i < 256:
-                return BINGET + pack("<B", i)
+                return _BINGET_HEADERS[i]
             else:
-                return LONG_BINGET + pack("<I", i)
+                return _pack_op_I(LONG_BINGET, i)
 
-        return GET + repr(i).encode("ascii") + b'\n'
+        return _GET_TEXT % i
 
     def save(self, obj, save_persistent_id=True):
         self.framer.commit_frame()
@@ -552,38 +1190,56 @@ class _Pickler:
         if reduce is not None:
             rv = reduce(obj)
 
-        if rv is NotImplemented:
-            # Check the type dispatch table
-            t = type(obj)
-            f = self.dispatch.get(t)
-            if f is not None:
-                f(self, obj)  # Call unbound method with explicit self
+        if rv is not NotImplemented:
+            self._save_reduce_value(obj, rv, reduce)
+            return
+
+        # Check the type dispatch table
+        t = type(obj)
+        f = self.dispatch.get(t)
+        if f is not None:
+            f(self, obj)  # Call unbound method with explicit self
+            return
+
+        # Check private dispatch table if any, or else
+        # copyreg.dispatch_table
+        reduce = getattr(self, 'dispatch_table', dispatch_table).get(t)
+        if reduce is None:
+            # Check for a class with a custom metaclass; treat as regular
+            # class
+            if issubclass(t, type):
+                self.save_global(obj)
+                return
+
+            # Enum members are dispatched on their metaclass, as each
+            # enumeration is a type of its own
+            if (isinstance(t, EnumMeta) and
+                    t.__reduce_ex__ is Enum.__reduce_ex__):
+                self.save_enum(obj)
                 return
 
-            # Check private dispatch table if any, or else
-            # copyreg.dispatch_table
-            reduce = getattr(self, 'dispatch_table', dispatch_table).get(t)
+        self._save_reduced(obj, reduce)
+
+    def _save_reduced(self, obj, reduce):
+        # Save obj through its dispatch_table entry reduce, or through its
+        # __reduce_ex__ or __reduce__ method if reduce is None.
+        if reduce is not None:
+            rv = reduce(obj)
+        else:
+            # Check for a __reduce_ex__ method, fall back to __reduce__
+            reduce = getattr(obj, "__reduce_ex__", None)
             if reduce is not None:
-                rv = reduce(obj)
+                rv = reduce(self.proto)
             else:
-                # Check for a class with a custom metaclass; treat as regular
-                # class
-                if issubclass(t, type):
-                    self.save_global(obj)
-                    return
-
-                # Check for a __reduce_ex__ method, fall back to __reduce__
-                reduce = getattr(obj, "__reduce_ex__", None)
+                reduce = getattr(obj, "__reduce__", None)
                 if reduce is not None:
-                    rv = reduce(self.proto)
+                    rv = reduce()
                 else:
-                    reduce = getattr(obj, "__reduce__", None)
-                    if reduce is not None:
-                        rv = reduce()
-                    else:
-                        raise PicklingError("Can't pickle %r object: %r" %
-                                            (t.__name__, obj))
+                    raise PicklingError("Can't pickle %r object: %r" %
+                                        (type(obj).__name__, obj))
+        self._save_reduce_value(obj, rv, reduce)
 
+    def _save_reduce_value(self, obj, rv, reduce):
         # Check for string returned by reduce(), meaning "save as global"
         if isinstance(rv, str):
             self.save_global(obj, rv)
@@ -756,32 +1412,32 @@ class _Pickler:
             # First one- and two-byte unsigned ints:
             if obj >= 0:
                 if obj <= 0xff:
-                    self.write(BININT1 + pack("<B", obj))
+                    self.write(_BININT1_HEADERS[obj])
                     return
                 if obj <= 0xffff:
-                    self.write(BININT2 + pack("<H", obj))
+                    self.write(_pack_op_H(BININT2, obj))
                     return
             # Next check for 4-byte signed ints:
             if -0x80000000 <= obj <= 0x7fffffff:
-                self.write(BININT + pack("<i", obj))
+                self.write(_pack_op_i(BININT, obj))
                 return
         if self.proto >= 2:
             encoded = encode_long(obj)
             n = len(encoded)
             if n < 256:
-                self.write(LONG1 + pack("<B", n) + encoded)
+                self.write(_LONG1_HEADERS[n] + encoded)
             else:
-                self.write(LONG4 + pack("<i", n) + encoded)
+                self.write(_pack_op_i(LONG4, n) + encoded)
             return
         if -0x80000000 <= obj <= 0x7fffffff:
-            self.write(INT + repr(obj).encode("ascii") + b'\n')
+            self.write(_INT_TEXT % obj)
         else:
-            self.write(LONG + repr(obj).encode("ascii") + b'L\n')
+            self.write(LONG + encode_decimal(obj) + b'L\n')
     dispatch[int] = save_long
 
     def save_float(self, obj):
         if self.bin:
-            self.write(BINFLOAT + pack('>d', obj))
+            self.write(_pack_op_d(BINFLOAT, obj))
         else:
             self.write(FLOAT + repr(obj).encode("ascii") + b'\n')
     dispatch[float] = save_float
@@ -794,17 +1450,22 @@ class _Pickler:
                 self.save_reduce(codecs.encode,
                                  (str(obj, 'latin1'), 'latin1'), obj=obj)
             return
-        n = len(obj)
+        self._write_bytes(obj)
+        self.memoize(obj)
+    dispatch[bytes] = save_bytes
+
+    def _write_bytes(self, data):
+        # Write the opcode for a bytes object with contents data, which can
+        # be any contiguous buffer of unsigned bytes; proto >= 3 only.
+        n = len(data)
         if n <= 0xff:
-            self.write(SHORT_BINBYTES + pack("<B", n) + obj)
+            self.write(_SHORT_BINBYTES_HEADERS[n] + data)
         elif n > 0xffffffff and self.proto >= 4:
-            self._write_large_bytes(BINBYTES8 + pack("<Q", n), obj)
+            self._write_large_bytes(_pack_op_Q(BINBYTES8, n), data)
         elif n >= self.framer._FRAME_SIZE_TARGET:
-            self._write_large_bytes(BINBYTES + pack("<I", n), obj)
+            self._write_large_bytes(_pack_op_I(BINBYTES, n), data)
         else:
-            self.write(BINBYTES + pack("<I", n) + obj)
-        self.memoize(obj)
-    dispatch[bytes] = save_bytes
+            self.write(_pack_op_I(BINBYTES, n) + data)
 
     def save_bytearray(self, obj):
         if self.proto < 5:
@@ -813,53 +1474,67 @@ class _Pickler:
             else:
                 self.save_reduce(bytearray, (bytes(obj),), obj=obj)
             return
-        n = len(obj)
-        if n >= self.framer._FRAME_SIZE_TARGET:
-            self._write_large_bytes(BYTEARRAY8 + pack("<Q", n), obj)
-        else:
-            self.write(BYTEARRAY8 + pack("<Q", n) + obj)
+        self._write_bytearray(obj)
         self.memoize(obj)
     dispatch[bytearray] = save_bytearray
 
+    def _write_bytearray(self, data):
+        # Same as _write_bytes() for a bytearray; proto >= 5 only.
+        n = len(data)
+        if n >= self.framer._FRAME_SIZE_TARGET:
+            self._write_large_bytes(_pack_op_Q(BYTEARRAY8, n), data)
+        else:
+            self.write(_pack_op_Q(BYTEARRAY8, n) + data)
+
     if _HAVE_PICKLE_BUFFER:
         def save_picklebuffer(self, obj):
             if self.proto < 5:
                 raise PicklingError("PickleBuffer can only pickled with "
                                     "protocol >= 5")
-            with obj.raw() as m:
-                if not m.contiguous:
-                    raise PicklingError("PickleBuffer can not be pickled when "
-                                        "pointing to a non-contiguous buffer")
-                in_band = True
-                if self._buffer_callback is not None:
-                    in_band = bool(self._buffer_callback(obj))
-                if in_band:
-                    # Write data in-band
-                    # XXX The C implementation avoids a copy here
-                    if m.readonly:
-                        self.save_bytes(m.tobytes())
-                    else:
-                        self.save_bytearray(m.tobytes())
+            m = obj.raw()
+            if not m.contiguous:
+                m.release()
+                raise PicklingError("PickleBuffer can not be pickled when "
+                                    "pointing to a non-contiguous buffer")
+            in_band = True
+            if self._buffer_callback is not None:
+                in_band = bool(self._buffer_callback(obj))
+            if in_band:
+                # Write data in-band, straight from the view and without an
+                # intermediate copy.  The view is not released here since a
+                # large payload may still be queued for a writebehind
+                # thread.  As in _pickle, the bytes or bytearray object the
+                # stream describes is memoized as the PickleBuffer, so that
+                # a repeat of it is written as a memo get.
+                if m.readonly:
+                    self._write_bytes(m)
                 else:
-                    # Write data out-of-band
-                    self.write(NEXT_BUFFER)
-                    if m.readonly:
-                        self.write(READONLY_BUFFER)
+                    self._write_bytearray(m)
+                self.memoize(obj)
+            else:
+                # Write data out-of-band
+                readonly = m.readonly
+                m.release()
+                self.write(NEXT_BUFFER)
+                if readonly:
+                    self.write(READONLY_BUFFER)
 
         dispatch[PickleBuffer] = save_picklebuffer
 
     def save_str(self, obj):
-        if self.bin:
+        if self.bin and len(obj) >= self.framer._LARGE_CHUNK_SIZE:
+            self._save_large_str(obj)
+        elif self.bin:
             encoded = obj.encode('utf-8', 'surrogatepass')
             n = len(encoded)
             if n <= 0xff and self.proto >= 4:
-                self.write(SHORT_BINUNICODE + pack("<B", n) + encoded)
+                self.write(_SHORT_BINUNICODE_HEADERS[n] + encoded)
             elif n > 0xffffffff and self.proto >= 4:
-                self._write_large_bytes(BINUNICODE8 + pack("<Q", n), encoded)
+                self._write_large_bytes(_pack_op_Q(BINUNICODE8, n), encoded)
             elif n >= self.framer._FRAME_SIZE_TARGET:
-                self._write_large_bytes(BINUNICODE + pack("<I", n), encoded)
+                self._write_large_bytes(_pack_op_I(BINUNICODE, n), encoded)
             else:
-                self.write(BINUNICODE + pack("<I", n) + encoded)
+                self.write(_pack_op_I(BINUNICODE, n) + encoded)
         else:
             obj = obj.replace("\\", "\\u005c")
             obj = obj.replace("\0", "\\u0000")
@@ -871,6 +1546,27 @@ class _Pickler:
         self.memoize(obj)
     dispatch[str] = save_str
 
+    def _save_large_str(self, obj):
+        # Encode and write obj a chunk at a time, instead of building the
+        # whole UTF-8 payload.  Its size is needed for the header first, so
+        # non-ASCII text is encoded twice.  Code points are encoded one by
+        # one, even lone surrogates, so the chunks add up to the same bytes.
+        size = self.framer._LARGE_CHUNK_SIZE
+
+        def chunks():
+            for i in range(0, len(obj), size):
+                yield obj[i:i + size].encode('utf-8', 'surrogatepass')
+
+        if obj.isascii():
+            n = len(obj)
+        else:
+            n = sum(map(len, chunks()))
+        if n > 0xffffffff and self.proto >= 4:
+            header = _pack_op_Q(BINUNICODE8, n)
+        else:
+            header = _pack_op_I(BINUNICODE, n)
+        self._write_large_chunks(header, chunks())
+
     def save_tuple(self, obj):
         if not obj: # tuple is empty
             if self.bin:
@@ -1082,11 +1778,11 @@ class _Pickler:
             if code:
                 assert code > 0
                 if code <= 0xff:
-                    write(EXT1 + pack("<B", code))
+                    write(_EXT1_HEADERS[code])
                 elif code <= 0xffff:
-                    write(EXT2 + pack("<H", code))
+                    write(_pack_op_H(EXT2, code))
                 else:
-                    write(EXT4 + pack("<i", code))
+                    write(_pack_op_i(EXT4, code))
                 return
         lastname = name.rpartition('.')[2]
         if parent is module:
@@ -1131,114 +1827,1063 @@ class _Pickler:
     dispatch[FunctionType] = save_global
     dispatch[type] = save_type
 
+    # Common standard library types reduce to a call of their class.  Their
+    # entries below write the same opcodes as saving that reduce value would,
+    # without going through __reduce_ex__() and save_reduce(), unless the
+    # dispatch_table of the pickler has a say.
 
-# Unpickling machinery
+    def _save_class_call(self, obj, cls, args):
+        # Same as self.save_reduce(cls, args, obj=obj), for a fresh tuple
+        # args
+        write = self.write
+        if self._plain_saves:
+            commit_frame = self.framer.commit_frame
+            commit_frame()
+            x = self.memo.get(id(cls))
+            if x is not None:
+                write(self.get(x[0]))
+            else:
+                self.save(cls)
+            commit_frame()
+            self.save_tuple(args)
+        else:
+            self.save(cls)
+            self.save(args)
+        write(REDUCE)
+        x = self.memo.get(id(obj))
+        if x is not None:
+            write(POP + self.get(x[0]))
+        else:
+            self.memoize(obj)
 
-class _Unpickler:
+    def _reducer(self, obj):
+        return getattr(self, 'dispatch_table', dispatch_table).get(type(obj))
 
-    def __init__(self, file, *, fix_imports=True,
-                 encoding="ASCII", errors="strict", buffers=None):
-        """This takes a binary file for reading a pickle data stream.
+    def save_datetime(self, obj):
+        reduce = self._reducer(obj)
+        if reduce is not None:
+            self._save_reduced(obj, reduce)
+            return
+        # The state of date and time objects is only exposed as the bytes
+        # built by their C implementation
+        cls, args = obj.__reduce_ex__(self.proto)
+        memo = self.memo
+        x = memo.get(id(cls))
+        if (len(args) > 1 or x is None or self.proto < 3 or self.fast or
+                not self._plain_saves):
+            self._save_class_call(obj, cls, args)
+            return
+        # Without a tzinfo nothing can refer back to obj, so the class, the
+        # bytes, the arguments tuple and obj are all written at once
+        commit_frame = self.framer.commit_frame
+        write = self.write
+        commit_frame()
+        write(self.get(x[0]))
+        commit_frame()
+        state = args[0]
+        idx = len(memo)
+        put = self.put
+        write(_SHORT_BINBYTES_HEADERS[len(state)] + state + put(idx) +
+              TUPLE1 + put(idx + 1) + REDUCE + put(idx + 2))
+        memo[id(state)] = idx, state
+        memo[id(args)] = idx + 1, args
+        memo[id(obj)] = idx + 2, obj
+    dispatch[datetime] = save_datetime
+    dispatch[date] = save_datetime
+    dispatch[time] = save_datetime
+    dispatch[timedelta] = save_datetime
+
+    def save_complex(self, obj):
+        reduce = self._reducer(obj)
+        if reduce is not _reduce_complex or reduce is None:
+            self._save_reduced(obj, reduce)
+            return
+        self._save_class_call(obj, complex, (obj.real, obj.imag))
+    dispatch[complex] = save_complex
 
-        The protocol version of the pickle is detected automatically, so
-        no proto argument is needed.
+    def save_range(self, obj):
+        reduce = self._reducer(obj)
+        if reduce is not None:
+            self._save_reduced(obj, reduce)
+            return
+        self._save_class_call(obj, type(obj), (obj.start, obj.stop, obj.step))
+    dispatch[range] = save_range
+    dispatch[slice] = save_range
 
-        The argument *file* must have two methods, a read() method that
-        takes an integer argument, and a readline() method that requires
-        no arguments.  Both methods should return bytes.  Thus *file*
-        can be a binary file object opened for reading, an io.BytesIO
-        object, or any other custom object that meets this interface.
+    def save_deque(self, obj):
+        reduce = self._reducer(obj)
+        if reduce is not None:
+            self._save_reduced(obj, reduce)
+            return
+        maxlen = obj.maxlen
+        self._save_class_call(obj, deque, () if maxlen is None else ((), maxlen))
+        self._batch_appends(iter(obj))
+    dispatch[deque] = save_deque
 
-        The file-like object must have two methods, a read() method
-        that takes an integer argument, and a readline() method that
-        requires no arguments.  Both methods should return bytes.
-        Thus file-like object can be a binary file object opened for
-        reading, a BytesIO object, or any other custom object that
-        meets this interface.
+    def save_decimal(self, obj):
+        reduce = self._reducer(obj)
+        if reduce is not None:
+            self._save_reduced(obj, reduce)
+            return
+        self._save_class_call(obj, Decimal, (str(obj),))
+    dispatch[Decimal] = save_decimal
+
+    def save_enum(self, obj):
+        # Called by save() for members of enumerations that keep the
+        # __reduce_ex__() of Enum
+        self._save_class_call(obj, type(obj), (obj._value_,))
+
+    # Arrays and memoryviews are written straight from their memory, as a
+    # PickleBuffer with protocol 5 so that they can be sent out-of-band.
+
+    # Typecodes of arrays whose items have the same size on every platform,
+    # and so can be sent out-of-band as plain little-endian bytes
+    _PORTABLE_TYPECODES = frozenset('bBhHiIfdqQ')
+
+    def _save_buffer(self, m):
+        # Save the contents of the contiguous byte view m as bytes if it is
+        # read-only and as a bytearray otherwise
+        if self.proto >= 5 and _HAVE_PICKLE_BUFFER:
+            self.save(PickleBuffer(m))
+        elif self.proto >= 5 and not m.readonly:
+            self.framer.commit_frame()
+            self._write_bytearray(m)
+        elif self.proto >= 3:
+            if not m.readonly:
+                self.save(bytearray)
+            self.framer.commit_frame()
+            self._write_bytes(m)
+            if not m.readonly:
+                self.write(TUPLE1 + REDUCE)
+        else:
+            self.save(m.tobytes() if m.readonly else bytearray(m))
+
+    def save_array(self, obj):
+        reduce = self._reducer(obj)
+        # Empty arrays reduce to the shared empty bytes object, which is
+        # memoized as such
+        if reduce is not None or self.proto < 3 or not obj:
+            self._save_reduced(obj, reduce)
+            return
+        save = self.save
+        write = self.write
+        m = memoryview(obj).cast('B')
+        if (self._buffer_callback is not None and _HAVE_PICKLE_BUFFER and
+                obj.typecode in self._PORTABLE_TYPECODES and
+                sys.byteorder == 'little'):
+            # array(typecode), then filled by frombytes(), which takes the
+            # out-of-band buffer as is.  _array_reconstructor() only takes
+            # bytes, so it is kept for in-band items.
+            self._save_class_call(obj, array, (obj.typecode,))
+            save(array.frombytes)
+            save(obj)
+            self._save_buffer(m)
+            write(TUPLE2 + REDUCE + POP)
+            return
+        # Same as the reduce value, _array_reconstructor(array, typecode,
+        # mformat_code, items), without copying the items to bytes first.
+        # The machine format code, taken from an empty slice, keeps the
+        # items portable across platforms with other sizes or byte orders.
+        func, (cls, typecode, mformat_code, _), _ = (
+            obj[:0].__reduce_ex__(self.proto))
+        save(func)
+        self.framer.commit_frame()
+        write(MARK)
+        save(cls)
+        save(typecode)
+        save(mformat_code)
+        self.framer.commit_frame()
+        self._write_bytes(m)
+        # Memo entries for the items and arguments that the reduce value
+        # would have had
+        self.memoize(object())
+        write(TUPLE)
+        self.memoize(object())
+        write(REDUCE)
+        self.memoize(obj)
+    dispatch[array] = save_array
 
-        If *buffers* is not None, it should be an iterable of buffer-enabled
-        objects that is consumed each time the pickle stream references
-        an out-of-band buffer view.  Such buffers have been given in order
-        to the *buffer_callback* of a Pickler object.
+    def save_memoryview(self, obj):
+        # memoryview.cast(memoryview(buffer), format, shape)
+        reduce = self._reducer(obj)
+        if reduce is not None:
+            self._save_reduced(obj, reduce)
+            return
+        save = self.save
+        write = self.write
+        m = obj
+        if not obj.c_contiguous:
+            m = obj.tobytes()
+            m = memoryview(m if obj.readonly else bytearray(m))
+        # One-dimensional views get their shape back from their size, which
+        # is all cast() accepts for empty ones
+        shape = obj.shape if obj.ndim != 1 else None
+        try:
+            m = m.cast('B')
+            if shape is None:
+                m.cast(obj.format)
+            else:
+                m.cast(obj.format, shape)
+        except (TypeError, ValueError) as err:
+            raise PicklingError("Can't pickle %r: %s" % (obj, err)) from None
+        proto2 = self.proto >= 2
+        save(memoryview.cast)
+        if not proto2:
+            write(MARK)
+        save(memoryview)
+        if not proto2:
+            write(MARK)
+        self._save_buffer(m)
+        write((TUPLE1 if proto2 else TUPLE) + REDUCE)
+        save(obj.format)
+        n = 2
+        if shape is not None:
+            save(shape)
+            n = 3
+        write((_tuplesize2code[n] if proto2 else TUPLE) + REDUCE)
+        self.memoize(obj)
+    dispatch[memoryview] = save_memoryview
 
-        If *buffers* is None (the default), then the buffers are taken
-        from the pickle stream, assuming they are serialized there.
-        It is an error for *buffers* to be None if the pickle stream
-        was produced with a non-None *buffer_callback*.
 
-        Other optional arguments are *fix_imports*, *encoding* and
-        *errors*, which are used to control compatibility support for
-        pickle stream generated by Python 2.  If *fix_imports* is True,
-        pickle will try to map the old Python 2 names to the new names
-        used in Python 3.  The *encoding* and *errors* tell pickle how
-        to decode 8-bit string instances pickled by Python 2; these
-        default to 'ASCII' and 'strict', respectively. *encoding* can be
-        'bytes' to read these 8-bit string instances as bytes objects.
-        """
-        self._buffers = iter(buffers) if buffers is not None else None
-        self._file_readline = file.readline
-        self._file_read = file.read
-        self.memo = {}
-        self.encoding = encoding
-        self.errors = errors
-        self.proto = 0
-        self.fix_imports = fix_imports
+# Specialized picklers
 
-    def load(self):
-        """Read a pickled object representation from the open file.
+class _SpecializedPickler(_Pickler):
 
-        Return the reconstituted object hierarchy specified in the file.
-        """
-        # Check whether Unpickler was initialized correctly. This is
-        # only needed to mimic the behavior of _pickle.Unpickler.dump().
-        if not hasattr(self, "_file_read"):
-            raise UnpicklingError("Unpickler.__init__() was not called by "
-                                  "%s.__init__()" % (self.__class__.__name__,))
-        self._unframer = _Unframer(self._file_read, self._file_readline)
-        self.read = self._unframer.read
-        self.readinto = self._unframer.readinto
-        self.readline = self._unframer.readline
-        self.metastack = []
-        self.stack = []
-        self.append = self.stack.append
-        self.proto = 0
-        read = self.read
-        dispatch = self.dispatch
-        try:
-            while True:
-                key = read(1)
-                if not key:
-                    raise EOFError
-                assert isinstance(key, bytes_types)
-                dispatch[key[0]](self)
-        except _Stop as stopinst:
-            return stopinst.value
+    # Base of the classes made by specialized_pickler().  While dump() runs,
+    # save() is replaced by a closure with the handlers of the most common
+    # types inlined for the protocol of the class, and the attributes they
+    # use bound as local variables.  Anything else is handed to the regular
+    # handlers, so the output is the same as that of Pickler.  The closure
+    # is built on the first dump() and kept for the next ones, until the
+    # memo, the fast mode or the file it was bound to is replaced.
 
-    # Return a list of items pushed in the stack after last MARK instruction.
-    def pop_mark(self):
-        items = self.stack
-        self.stack = self.metastack.pop()
-        self.append = self.stack.append
-        return items
+    _protocol = DEFAULT_PROTOCOL
+    _fix_imports = True
 
-    def persistent_load(self, pid):
-        raise UnpicklingError("unsupported persistent id encountered")
+    def __init__(self, file, *, buffer_callback=None, writebehind=0):
+        super().__init__(file, self._protocol, fix_imports=self._fix_imports,
+                         buffer_callback=buffer_callback,
+                         writebehind=writebehind)
+        self._specialized = None
 
-    dispatch = {}
+    def dump(self, obj):
+        """Write a pickled representation of obj to the open file."""
+        # A persistent_id() or reducer_override() has to see every object,
+        # which only the regular save() guarantees.
+        specialize = (
+            getattr(self, "reducer_override", None) is None and
+            getattr(self.persistent_id, "__func__", None)
+            is _Pickler.persistent_id and
+            hasattr(self, "_file_write"))
+        if specialize:
+            cached = self._specialized
+            if (cached is None or cached[0] is not self.memo or
+                    cached[1] != self.fast or cached[2] is not self.write):
+                cached = self._specialized = (self.memo, self.fast,
+                                              self.write,
+                                              _specialized_save(self))
+            self.save = cached[3]
+        try:
+            super().dump(obj)
+        finally:
+            if specialize:
+                del self.save
+
+
+def _specialized_save(self):
+    # Return the save() used by dump() of the _SpecializedPickler self.
+    proto = self.proto
+    binary = self.bin
+    write = self.write
+    commit_frame = self.framer.commit_frame
+    memo = self.memo
+    memo_get = memo.get
+    generic_save = partial(_Pickler.save, self)
+    batchsize = self._BATCHSIZE
+    small_str = self.framer._FRAME_SIZE_TARGET // 4
+    small_bytes = self.framer._FRAME_SIZE_TARGET
+
+    if binary:
+        def get(i):
+            return _BINGET_HEADERS[i] if i < 256 else _pack_op_I(LONG_BINGET, i)
+    else:
+        def get(i):
+            return _GET_TEXT % i
 
-    def load_proto(self):
-        proto = self.read(1)[0]
-        if not 0 <= proto <= HIGHEST_PROTOCOL:
-            raise ValueError("unsupported pickle protocol: %d" % proto)
-        self.proto = proto
-    dispatch[PROTO[0]] = load_proto
+    if self.fast:
+        def memoize(obj):
+            pass
+    elif proto >= 4:
+        def memoize(obj):
+            write(MEMOIZE)
+            memo[id(obj)] = len(memo), obj
+    elif binary:
+        def memoize(obj):
+            idx = len(memo)
+            write(_BINPUT_HEADERS[idx] if idx < 256
+                  else _pack_op_I(LONG_BINPUT, idx))
+            memo[id(obj)] = idx, obj
+    else:
+        def memoize(obj):
+            idx = len(memo)
+            write(_PUT_TEXT % idx)
+            memo[id(obj)] = idx, obj
+
+    def save(obj, save_persistent_id=True):
+        commit_frame()
+        x = memo_get(id(obj))
+        if x is not None:
+            write(get(x[0]))
+            return
+        f = handlers.get(type(obj))
+        if f is not None:
+            f(obj)
+        else:
+            generic_save(obj, save_persistent_id)
+
+    def save_none(obj):
+        write(NONE)
+
+    true, false = (NEWTRUE, NEWFALSE) if proto >= 2 else (TRUE, FALSE)
+    def save_bool(obj):
+        write(true if obj else false)
+
+    if binary:
+        def save_long(obj):
+            if 0 <= obj <= 0xff:
+                write(_BININT1_HEADERS[obj])
+            elif 0 <= obj <= 0xffff:
+                write(_pack_op_H(BININT2, obj))
+            elif -0x80000000 <= obj <= 0x7fffffff:
+                write(_pack_op_i(BININT, obj))
+            else:
+                self.save_long(obj)
 
-    def load_frame(self):
-        frame_size, = unpack('<Q', self.read(8))
-        if frame_size > sys.maxsize:
-            raise ValueError("frame size > sys.maxsize: %d" % frame_size)
-        self._unframer.load_frame(frame_size)
-    dispatch[FRAME[0]] = load_frame
+        def save_float(obj):
+            write(_pack_op_d(BINFLOAT, obj))
+    else:
+        def save_long(obj):
+            if -0x80000000 <= obj <= 0x7fffffff:
+                write(_INT_TEXT % obj)
+            else:
+                self.save_long(obj)
+
+        def save_float(obj):
+            write(FLOAT + repr(obj).encode("ascii") + b'\n')
+
+    if proto >= 4:
+        def save_str(obj):
+            if len(obj) >= small_str:
+                self.save_str(obj)
+                return
+            encoded = obj.encode('utf-8', 'surrogatepass')
+            n = len(encoded)
+            if n <= 0xff:
+                write(_SHORT_BINUNICODE_HEADERS[n] + encoded)
+            else:
+                write(_pack_op_I(BINUNICODE, n) + encoded)
+            memoize(obj)
+    elif binary:
+        def save_str(obj):
+            if len(obj) >= small_str:
+                self.save_str(obj)
+                return
+            encoded = obj.encode('utf-8', 'surrogatepass')
+            write(_pack_op_I(BINUNICODE, len(encoded)) + encoded)
+            memoize(obj)
+    else:
+        def save_str(obj):
+            obj = obj.replace("\\", "\\u005c")
+            obj = obj.replace("\0", "\\u0000")
+            obj = obj.replace("\n", "\\u000a")
+            obj = obj.replace("\r", "\\u000d")
+            obj = obj.replace("\x1a", "\\u001a")
+            write(UNICODE + obj.encode('raw-unicode-escape') + b'\n')
+            memoize(obj)
+
+    if binary:
+        def save_list(obj):
+            write(EMPTY_LIST)
+            memoize(obj)
+            n = len(obj)
+            if n == 1:
+                save(obj[0])
+                write(APPEND)
+            elif 1 < n <= batchsize:
+                write(MARK)
+                for x in obj[:]:
+                    save(x)
+                write(APPENDS)
+            elif n:
+                self._batch_appends(obj)
+
+        def save_dict(obj):
+            write(EMPTY_DICT)
+            memoize(obj)
+            n = len(obj)
+            if n == 1:
+                (k, v), = obj.items()
+                save(k)
+                save(v)
+                write(SETITEM)
+            elif 1 < n <= batchsize:
+                write(MARK)
+                for k, v in list(obj.items()):
+                    save(k)
+                    save(v)
+                write(SETITEMS)
+            elif n:
+                self._batch_setitems(obj.items())
+    else:
+        def save_list(obj):
+            write(MARK + LIST)
+            memoize(obj)
+            for x in obj:
+                save(x)
+                write(APPEND)
+
+        def save_dict(obj):
+            write(MARK + DICT)
+            memoize(obj)
+            for k, v in obj.items():
+                save(k)
+                save(v)
+                write(SETITEM)
+
+    def save_tuple(obj):
+        n = len(obj)
+        if not n:
+            write(EMPTY_TUPLE if binary else MARK + TUPLE)
+            return
+        if n <= 3 and proto >= 2:
+            for element in obj:
+                save(element)
+            x = memo_get(id(obj))
+            if x is not None:
+                write(POP * n + get(x[0]))
+            else:
+                write(_tuplesize2code[n])
+                memoize(obj)
+            return
+        write(MARK)
+        for element in obj:
+            save(element)
+        x = memo_get(id(obj))
+        if x is not None:
+            # The tuple is recursive, see save_tuple()
+            write((POP_MARK if binary else POP * (n + 1)) + get(x[0]))
+        else:
+            write(TUPLE)
+            memoize(obj)
+
+    handlers = {type(None): save_none, bool: save_bool, int: save_long,
+                float: save_float, str: save_str, list: save_list,
+                dict: save_dict, tuple: save_tuple}
+
+    if proto >= 3:
+        def save_bytes(obj):
+            n = len(obj)
+            if n <= 0xff:
+                write(_SHORT_BINBYTES_HEADERS[n] + obj)
+            elif n < small_bytes:
+                write(_pack_op_I(BINBYTES, n) + obj)
+            else:
+                self.save_bytes(obj)
+                return
+            memoize(obj)
+        handlers[bytes] = save_bytes
+
+    # Types that self dispatches to handlers of its own keep them
+    for t in list(handlers):
+        if self.dispatch.get(t) is not _Pickler.dispatch.get(t):
+            del handlers[t]
+    return save
+
+_specialized_classes = {}
+
+def specialized_pickler(protocol=None, *, fix_imports=True):
+    """Return a Pickler class specialized for *protocol* and *fix_imports*.
+
+    Instances are created with the *file* and the keyword arguments of
+    Pickler, and write the same bytes as Pickler with the same options.
+    Protocol checks are done once per instance instead of once per object,
+    so pickling is faster, mostly for containers of small ints, floats and
+    strings, and for streams of small messages dumped by one instance.  Pickling falls back to the generic code path when the
+    instance has a persistent_id() or a reducer_override() method.
+    """
+    if protocol is None:
+        protocol = DEFAULT_PROTOCOL
+    if protocol < 0:
+        protocol = HIGHEST_PROTOCOL
+    elif not 0 <= protocol <= HIGHEST_PROTOCOL:
+        raise ValueError("pickle protocol must be <= %d" % HIGHEST_PROTOCOL)
+    key = protocol, bool(fix_imports)
+    cls = _specialized_classes.get(key)
+    if cls is None:
+        name = "Protocol%dPickler" % protocol
+        cls = type(name, (_SpecializedPickler,),
+                   {"_protocol": protocol, "_fix_imports": key[1],
+                    "__qualname__": name, "__module__": __name__})
+        _specialized_classes[key] = cls
+    return cls
+
+
+# Protocol sweeps
+
+class _ProtocolSweep:
+
+    # Pickle one object with several protocols at once.  The object graph
+    # is walked a single time, and each node is handed to the group of
+    # picklers that have not memoized it yet.  Opcodes that several
+    # protocols share are encoded once for all of them.  Types without a
+    # walker below are saved by each pickler of the group on its own, which
+    # writes the same bytes as a regular dump() as every pickler keeps its
+    # own memo and framer.
+
+    def __init__(self, protocols, fix_imports):
+        self.files = [io.BytesIO() for _ in protocols]
+        self.picklers = [_Pickler(f, protocol, fix_imports=fix_imports)
+                         for f, protocol in zip(self.files, protocols)]
+
+    def dump(self, obj):
+        """Pickle obj with every pickler; return the list of pickles."""
+        for p in self.picklers:
+            if p.proto >= 2:
+                p.write(_PROTO_HEADERS[p.proto])
+            p.framer.start_framing(framed=p.proto >= 4)
+            p._plain_saves = True
+        self.save(obj, self.picklers)
+        for p in self.picklers:
+            p.write(STOP)
+            p.framer.end_framing()
+        return [f.getvalue() for f in self.files]
+
+    def save(self, obj, group):
+        # Write obj to the stream of every pickler in group
+        t = type(obj)
+        if t in self.unmemoized:
+            # No save_*() method memoizes these, so the memo is no use
+            for p in group:
+                p.framer.commit_frame()
+            self.dispatch[t](self, obj, group)
+            return
+        key = id(obj)
+        rest = []
+        for p in group:
+            p.framer.commit_frame()
+            x = p.memo.get(key)
+            if x is not None:
+                p.write(p.get(x[0]))
+            else:
+                rest.append(p)
+        if not rest:
+            return
+        f = self.dispatch.get(t)
+        if f is not None:
+            f(self, obj, rest)
+        else:
+            for p in rest:
+                p.save(obj)
+
+    dispatch = {}
+
+    def save_none(self, obj, group):
+        for p in group:
+            p.write(NONE)
+    dispatch[type(None)] = save_none
+
+    def save_bool(self, obj, group):
+        for p in group:
+            if p.proto >= 2:
+                p.write(NEWTRUE if obj else NEWFALSE)
+            else:
+                p.write(TRUE if obj else FALSE)
+    dispatch[bool] = save_bool
+
+    def save_long(self, obj, group):
+        if not -0x80000000 <= obj <= 0x7fffffff:
+            for p in group:
+                p.save_long(obj)
+            return
+        binary = text = None
+        for p in group:
+            if p.bin:
+                if binary is None:
+                    if 0 <= obj <= 0xff:
+                        binary = _BININT1_HEADERS[obj]
+                    elif 0 <= obj <= 0xffff:
+                        binary = _pack_op_H(BININT2, obj)
+                    else:
+                        binary = _pack_op_i(BININT, obj)
+                p.write(binary)
+            else:
+                if text is None:
+                    text = _INT_TEXT % obj
+                p.write(text)
+    dispatch[int] = save_long
+
+    def save_float(self, obj, group):
+        binary = text = None
+        for p in group:
+            if p.bin:
+                if binary is None:
+                    binary = _pack_op_d(BINFLOAT, obj)
+                p.write(binary)
+            else:
+                if text is None:
+                    text = FLOAT + repr(obj).encode("ascii") + b'\n'
+                p.write(text)
+    dispatch[float] = save_float
+
+    unmemoized = {type(None), bool, int, float}
+
+    def save_str(self, obj, group):
+        if len(obj) >= _Framer._FRAME_SIZE_TARGET // 4:
+            for p in group:
+                p.save_str(obj)
+            return
+        encoded = short = None
+        for p in group:
+            if not p.bin:
+                p.save_str(obj)
+                continue
+            if encoded is None:
+                encoded = obj.encode('utf-8', 'surrogatepass')
+                n = len(encoded)
+                data = _pack_op_I(BINUNICODE, n) + encoded
+                if n <= 0xff:
+                    short = _SHORT_BINUNICODE_HEADERS[n] + encoded
+                else:
+                    short = data
+            p.write(short if p.proto >= 4 else data)
+            p.memoize(obj)
+    dispatch[str] = save_str
+
+    def save_bytes(self, obj, group):
+        n = len(obj)
+        data = None
+        for p in group:
+            if p.proto < 3 or n >= _Framer._FRAME_SIZE_TARGET:
+                p.save_bytes(obj)
+                continue
+            if data is None:
+                if n <= 0xff:
+                    data = _SHORT_BINBYTES_HEADERS[n] + obj
+                else:
+                    data = _pack_op_I(BINBYTES, n) + obj
+            p.write(data)
+            p.memoize(obj)
+    dispatch[bytes] = save_bytes
+
+    def save_tuple(self, obj, group):
+        n = len(obj)
+        if not n:
+            for p in group:
+                p.write(EMPTY_TUPLE if p.bin else MARK + TUPLE)
+            return
+        for p in group:
+            if n > 3 or p.proto < 2:
+                p.write(MARK)
+        for element in obj:
+            self.save(element, group)
+        for p in group:
+            x = p.memo.get(id(obj))
+            if x is not None:
+                # The tuple is recursive, see _Pickler.save_tuple()
+                if n <= 3 and p.proto >= 2:
+                    pop = POP * n
+                else:
+                    pop = POP_MARK if p.bin else POP * (n + 1)
+                p.write(pop + p.get(x[0]))
+            else:
+                p.write(_tuplesize2code[n] if n <= 3 and p.proto >= 2
+                        else TUPLE)
+                p.memoize(obj)
+    dispatch[tuple] = save_tuple
+
+    def save_list(self, obj, group):
+        for p in group:
+            p.write(EMPTY_LIST if p.bin else MARK + LIST)
+            p.memoize(obj)
+        self._batch(obj, group, False, APPEND, APPENDS)
+    dispatch[list] = save_list
+
+    def save_dict(self, obj, group):
+        for p in group:
+            p.write(EMPTY_DICT if p.bin else MARK + DICT)
+            p.memoize(obj)
+        self._batch(obj.items(), group, True, SETITEM, SETITEMS)
+    dispatch[dict] = save_dict
+
+    def _batch(self, items, group, pairs, one, many):
+        # Save items as _batch_appends() or _batch_setitems() do: in batches
+        # of _BATCHSIZE with MARK ... many or a single item and one for
+        # binary protocols, and one item at a time for protocol 0.
+        save = self.save
+        binary = [p for p in group if p.bin]
+        text = [p for p in group if not p.bin]
+        it = iter(items)
+        while True:
+            tmp = list(islice(it, _Pickler._BATCHSIZE))
+            n = len(tmp)
+            if n > 1:
+                for p in binary:
+                    p.write(MARK)
+            for x in tmp:
+                if pairs:
+                    k, v = x
+                    save(k, group)
+                    save(v, group)
+                else:
+                    save(x, group)
+                for p in text:
+                    p.write(one)
+            if n:
+                for p in binary:
+                    p.write(many if n > 1 else one)
+            if n < _Pickler._BATCHSIZE:
+                return
+
+def dumps_all_protocols(obj, protocols=None, *, fix_imports=True,
+                        digest=None):
+    """Pickle obj with each of *protocols* and return a dict of the results.
+
+    The dict maps each protocol to the same bytes as dumps(obj, protocol)
+    returns, or to their hexadecimal digest if *digest* names a hashlib
+    algorithm such as "sha256".  *protocols* defaults to all protocols
+    from 0 to HIGHEST_PROTOCOL.  The object is walked once for all of
+    them, which makes this faster than one dumps() call per protocol.
+    """
+    if protocols is None:
+        protocols = range(HIGHEST_PROTOCOL + 1)
+    selected = []
+    for protocol in protocols:
+        if protocol < 0:
+            protocol = HIGHEST_PROTOCOL
+        elif protocol > HIGHEST_PROTOCOL:
+            raise ValueError("pickle protocol must be <= %d" % HIGHEST_PROTOCOL)
+        if protocol not in selected:
+            selected.append(protocol)
+    results = _ProtocolSweep(selected, fix_imports).dump(obj)
+    if digest is not None:
+        import hashlib
+        results = [hashlib.new(digest, data).hexdigest() for data in results]
+    return dict(zip(selected, results))
+
+
+# Unpickling machinery
+
+class _Unpickler:
+
+    def __init__(self, file, *, fix_imports=True,
+                 encoding="ASCII", errors="strict", buffers=None,
+                 readahead=0, buffered=None, use_mmap=False,
+                 zero_copy=False, allocator=None, max_frame_size=None,
+                 max_memo_entries=None, max_stack_depth=None,
+                 max_bytes_length=None, max_total_bytes=None):
+        """This takes a binary file for reading a pickle data stream.
+
+        The protocol version of the pickle is detected automatically, so
+        no proto argument is needed.
+
+        The argument *file* must have two methods, a read() method that
+        takes an integer argument, and a readline() method that requires
+        no arguments.  Both methods should return bytes.  Thus *file*
+        can be a binary file object opened for reading, an io.BytesIO
+        object, or any other custom object that meets this interface.
+
+        The file-like object must have two methods, a read() method
+        that takes an integer argument, and a readline() method that
+        requires no arguments.  Both methods should return bytes.
+        Thus file-like object can be a binary file object opened for
+        reading, a BytesIO object, or any other custom object that
+        meets this interface.
+
+        If *buffers* is not None, it should be an iterable of buffer-enabled
+        objects that is consumed each time the pickle stream references
+        an out-of-band buffer view.  Such buffers have been given in order
+        to the *buffer_callback* of a Pickler object.
+
+        If *buffers* is None (the default), then the buffers are taken
+        from the pickle stream, assuming they are serialized there.
+        It is an error for *buffers* to be None if the pickle stream
+        was produced with a non-None *buffer_callback*.
+
+        Other optional arguments are *fix_imports*, *encoding* and
+        *errors*, which are used to control compatibility support for
+        pickle stream generated by Python 2.  If *fix_imports* is True,
+        pickle will try to map the old Python 2 names to the new names
+        used in Python 3.  The *encoding* and *errors* tell pickle how
+        to decode 8-bit string instances pickled by Python 2; these
+        default to 'ASCII' and 'strict', respectively. *encoding* can be
+        'bytes' to read these 8-bit string instances as bytes objects.
+
+        If *readahead* is a positive integer, the frames of a protocol 4+
+        stream are read by a background thread while the current frame is
+        decoded, keeping at most *readahead* frames buffered.  Nothing
+        beyond the end of the pickle is read from *file*.
+
+        If *buffered* is true, data outside of frames is read from *file*
+        in large chunks rather than opcode by opcode.  Bytes read beyond
+        the end of a pickle are handed back to *file* by seeking if it is
+        seekable, and are otherwise kept for the next load() and exposed
+        as the *remainder* attribute.  The default, None, buffers raw
+        (unbuffered) seekable files only.
+
+        If *use_mmap* is true and *file* is a regular file, load() maps it
+        into memory and decodes straight from the mapping; large str and
+        bytearray payloads are then built without an intermediate copy.
+        With *zero_copy* also true, BINBYTES and BINBYTES8 payloads stored
+        outside of frames are returned as read-only memoryviews over the
+        mapping instead of bytes objects.  Other files are read as usual.
+
+        If *allocator* is not None, it is called with a size n and must
+        return a writable buffer of n bytes, such as a bytearray or a
+        pooled buffer.  BYTEARRAY8, BINBYTES and BINBYTES8 payloads large
+        enough to be stored outside of frames are then read straight into
+        such a buffer, which is returned in place of the bytearray or
+        bytes object.  Payloads are read with the readinto() method of
+        *file* when it has one.
+
+        The *max_frame_size*, *max_memo_entries*, *max_stack_depth*,
+        *max_bytes_length* and *max_total_bytes* arguments put limits on
+        what a load() may allocate, so that a truncated or hostile stream
+        fails before it uses up memory.  Each is None (no limit) by
+        default.  *max_stack_depth* counts the objects on the stack,
+        including those set aside by MARK.  *max_bytes_length* applies
+        to every length-prefixed bytes, bytearray, str and int payload,
+        and *max_total_bytes* to the sum of the sizes of all frames and of
+        these payloads, as declared before anything is read.  The text
+        lines that carry the arguments of protocol 0 opcodes count as
+        payloads too, once read.  Exceeding a limit raises the matching
+        subclass of UnpicklingBudgetError.
+        """
+        if readahead < 0:
+            raise ValueError("readahead must be >= 0")
+        budgets = (max_frame_size, max_memo_entries, max_stack_depth,
+                   max_bytes_length, max_total_bytes)
+        if any(budget is not None and budget < 0 for budget in budgets):
+            raise ValueError("resource budgets must be >= 0")
+        self._budgeted = any(budget is not None for budget in budgets)
+        self._max_frame_size = max_frame_size
+        self._max_memo_entries = max_memo_entries
+        self._max_stack_depth = max_stack_depth
+        self._max_bytes_length = max_bytes_length
+        self._max_total_bytes = max_total_bytes
+        self._total_bytes = 0
+        self._readahead = readahead
+        self._read_ahead = None
+        self._file = file
+        self._use_mmap = use_mmap
+        self._zero_copy = zero_copy
+        self._allocator = allocator
+        if buffered is None:
+            buffered = isinstance(file, io.RawIOBase) and _seekable(file)
+        self._buffers = iter(buffers) if buffers is not None else None
+        if buffered:
+            self._read_buffer = _ReadBuffer(file)
+            self._file_readline = self._read_buffer.readline
+            self._file_read = self._read_buffer.read
+            self._file_readinto = self._read_buffer.readinto
+        else:
+            self._read_buffer = None
+            self._file_readline = file.readline
+            self._file_read = file.read
+            self._file_readinto = getattr(file, 'readinto', None)
+        self.memo = {}
+        self.encoding = encoding
+        self.errors = errors
+        self.proto = 0
+        self.fix_imports = fix_imports
+
+    def load(self):
+        """Read a pickled object representation from the open file.
+
+        Return the reconstituted object hierarchy specified in the file.
+        """
+        # Check whether Unpickler was initialized correctly. This is
+        # only needed to mimic the behavior of _pickle.Unpickler.dump().
+        if not hasattr(self, "_file_read"):
+            raise UnpicklingError("Unpickler.__init__() was not called by "
+                                  "%s.__init__()" % (self.__class__.__name__,))
+        file_read = self._file_read
+        file_readline = self._file_readline
+        file_readinto = self._file_readinto
+        mapped = None
+        if self._use_mmap:
+            mapped = _MappedFile.open(self._file)
+        if mapped is not None:
+            self._unframer = _Unframer(mapped.read, mapped.readline,
+                                       file_readinto=mapped.readinto,
+                                       file_readview=mapped.readview)
+        else:
+            if self._readahead:
+                limits = [budget for budget in (self._max_frame_size,
+                                                self._max_bytes_length,
+                                                self._max_total_bytes)
+                          if budget is not None]
+                self._read_ahead = _ReadAhead(file_read, file_readline,
+                                              self._readahead, file_readinto,
+                                              min(limits, default=maxsize))
+                file_read = self._read_ahead.read
+                file_readline = self._read_ahead.readline
+                file_readinto = self._read_ahead.readinto
+            self._unframer = _Unframer(file_read, file_readline,
+                                       file_readinto=file_readinto)
+        # Until a FRAME opcode shows up, which protocols 0 to 3 never
+        # write, the opcodes and their text arguments are read straight from
+        # the file rather than through the unframer.
+        self.read = file_read
+        self.readline = file_readline
+        self.readinto = self._unframer.readinto
+        if mapped is not None:
+            self.read = mapped.read
+            self.readline = mapped.readline
+            self.readview = mapped.readview
+        else:
+            self.readview = self.read
+        self._read_bytes = (self.readview if self._zero_copy
+                            else self.read)
+        if self._budgeted:
+            self.readline = self._checked_readline(self.readline, False)
+        self.metastack = []
+        self.stack = []
+        self.append = self.stack.append
+        self.proto = 0
+        self._total_bytes = 0
+        dispatch = self.dispatch
+        try:
+            if self._budgeted:
+                self._load_checked(dispatch)
+            while True:
+                key = self.read(1)
+                if not key:
+                    raise EOFError
+                assert isinstance(key, bytes_types)
+                dispatch[key[0]](self)
+        except _Stop as stopinst:
+            return stopinst.value
+        finally:
+            if mapped is not None:
+                mapped.close()
+            if self._read_ahead is not None:
+                self._read_ahead.close()
+                self._read_ahead = None
+            if self._read_buffer is not None:
+                self._read_buffer.give_back()
+
+    @property
+    def remainder(self):
+        """Bytes read from the file but not consumed by the last load()."""
+        if self._read_buffer is None:
+            return b''
+        return self._read_buffer.remainder
+
+    def _start_unframing(self):
+        # Called on the first FRAME opcode: from now on every read goes
+        # through the unframer
+        unframer = self._unframer
+        self.read = unframer.read
+        self.readline = unframer.readline
+        if self._budgeted:
+            self.readline = self._checked_readline(self.readline, True)
+        self.readview = unframer.readview
+        self._read_bytes = (self.readview if self._zero_copy
+                            else self.read)
+
+    def _checked_readline(self, readline, framed):
+        # Wrap readline so that the text lines that carry the arguments of
+        # protocol 0 opcodes count as payloads.  Lines read from a frame are
+        # already part of the total that the frame was charged for.
+        check = self._check_length if framed else self._charge
+
+        def checked():
+            line = readline()
+            check(len(line), "text line")
+            return line
+        return checked
+
+    def _load_checked(self, dispatch):
+        # The dispatch loop of load(), checking the size of the memo and
+        # the stack after every opcode.  Neither grows by more than one
+        # object per opcode, so they are caught on the first excess entry.
+        max_memo = self._max_memo_entries
+        max_depth = self._max_stack_depth
+        memo = self.memo
+        metastack = self.metastack
+        marks = held = 0
+        while True:
+            key = self.read(1)
+            if not key:
+                raise EOFError
+            assert isinstance(key, bytes_types)
+            dispatch[key[0]](self)
+            if max_memo is not None and len(memo) > max_memo:
+                raise MemoTooLargeError("memo exceeds max_memo_entries "
+                                        "of %d" % max_memo)
+            if max_depth is not None:
+                if len(metastack) != marks:
+                    marks = len(metastack)
+                    held = sum(map(len, metastack))
+                if len(self.stack) + held > max_depth:
+                    raise StackTooDeepError("stack exceeds max_stack_depth "
+                                            "of %d" % max_depth)
+
+    def _charge(self, n, what):
+        # Account for an allocation of n bytes, before it is made.
+        self._check_length(n, what)
+        self._charge_total(n)
+
+    def _check_length(self, n, what):
+        if self._max_bytes_length is not None and n > self._max_bytes_length:
+            raise PayloadTooLargeError("%s of %d bytes exceeds "
+                                       "max_bytes_length of %d"
+                                       % (what, n, self._max_bytes_length))
+
+    def _charge_total(self, n):
+        self._total_bytes += n
+        if (self._max_total_bytes is not None and
+                self._total_bytes > self._max_total_bytes):
+            raise AllocationBudgetError("frames and payloads exceed "
+                                        "max_total_bytes of %d"
+                                        % self._max_total_bytes)
+
+    # Return a list of items pushed in the stack after last MARK instruction.
+    def pop_mark(self):
+        items = self.stack
+        self.stack = self.metastack.pop()
+        self.append = self.stack.append
+        return items
+
+    def persistent_load(self, pid):
+        raise UnpicklingError("unsupported persistent id encountered")
+
+    dispatch = {}
+
+    def load_proto(self):
+        proto = self.read(1)[0]
+        if not 0 <= proto <= HIGHEST_PROTOCOL:
+            raise ValueError("unsupported pickle protocol: %d" % proto)
+        self.proto = proto
+    dispatch[PROTO[0]] = load_proto
+
+    def load_frame(self):
+        frame_size, = unpack('<Q', self.read(8))
+        if frame_size > sys.maxsize:
+            raise ValueError("frame size > sys.maxsize: %d" % frame_size)
+        if self._budgeted:
+            if (self._max_frame_size is not None and
+                    frame_size > self._max_frame_size):
+                raise FrameTooLargeError("frame of %d bytes exceeds "
+                                         "max_frame_size of %d"
+                                         % (frame_size, self._max_frame_size))
+            self._charge_total(frame_size)
+        if self.read != self._unframer.read:
+            self._start_unframing()
+        self._unframer.load_frame(frame_size)
+        if self._read_ahead is not None:
+            self._read_ahead.resume()
+    dispatch[FRAME[0]] = load_frame
 
     def load_persid(self):
         try:
@@ -1273,7 +2918,7 @@ class _Unpickler:
         elif data == TRUE[1:]:
             val = True
         else:
-            val = int(data, 0)
+            val = decode_decimal(data)
         self.append(val)
     dispatch[INT[0]] = load_int
 
@@ -1293,11 +2938,13 @@ class _Unpickler:
         val = self.readline()[:-1]
         if val and val[-1] == b'L'[0]:
             val = val[:-1]
-        self.append(int(val, 0))
+        self.append(decode_decimal(val))
     dispatch[LONG[0]] = load_long
 
     def load_long1(self):
         n = self.read(1)[0]
+        if self._budgeted:
+            self._charge(n, "LONG1")
         data = self.read(n)
         self.append(decode_long(data))
     dispatch[LONG1[0]] = load_long1
@@ -1307,6 +2954,8 @@ class _Unpickler:
         if n < 0:
             # Corrupt or hostile pickle -- we never write one like this
             raise UnpicklingError("LONG pickle has negative byte count")
+        if self._budgeted:
+            self._charge(n, "LONG4")
         data = self.read(n)
         self.append(decode_long(data))
     dispatch[LONG4[0]] = load_long4
@@ -1343,6 +2992,8 @@ class _Unpickler:
         len, = unpack('<i', self.read(4))
         if len < 0:
             raise UnpicklingError("BINSTRING pickle has negative byte count")
+        if self._budgeted:
+            self._charge(len, "BINSTRING")
         data = self.read(len)
         self.append(self._decode_string(data))
     dispatch[BINSTRING[0]] = load_binstring
@@ -1352,7 +3003,9 @@ class _Unpickler:
         if len > maxsize:
             raise UnpicklingError("BINBYTES exceeds system's maximum size "
                                   "of %d bytes" % maxsize)
-        self.append(self.read(len))
+        if self._budgeted:
+            self._charge(len, "BINBYTES")
+        self.append(self._read_payload(len, self._read_bytes))
     dispatch[BINBYTES[0]] = load_binbytes
 
     def load_unicode(self):
@@ -1364,7 +3017,9 @@ class _Unpickler:
         if len > maxsize:
             raise UnpicklingError("BINUNICODE exceeds system's maximum size "
                                   "of %d bytes" % maxsize)
-        self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
+        if self._budgeted:
+            self._charge(len, "BINUNICODE")
+        self.append(str(self.readview(len), 'utf-8', 'surrogatepass'))
     dispatch[BINUNICODE[0]] = load_binunicode
 
     def load_binunicode8(self):
@@ -1372,7 +3027,9 @@ class _Unpickler:
         if len > maxsize:
             raise UnpicklingError("BINUNICODE8 exceeds system's maximum size "
                                   "of %d bytes" % maxsize)
-        self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
+        if self._budgeted:
+            self._charge(len, "BINUNICODE8")
+        self.append(str(self.readview(len), 'utf-8', 'surrogatepass'))
     dispatch[BINUNICODE8[0]] = load_binunicode8
 
     def load_binbytes8(self):
@@ -1380,7 +3037,9 @@ class _Unpickler:
         if len > maxsize:
             raise UnpicklingError("BINBYTES8 exceeds system's maximum size "
                                   "of %d bytes" % maxsize)
-        self.append(self.read(len))
+        if self._budgeted:
+            self._charge(len, "BINBYTES8")
+        self.append(self._read_payload(len, self._read_bytes))
     dispatch[BINBYTES8[0]] = load_binbytes8
 
     def load_bytearray8(self):
@@ -1388,11 +3047,29 @@ class _Unpickler:
         if len > maxsize:
             raise UnpicklingError("BYTEARRAY8 exceeds system's maximum size "
                                   "of %d bytes" % maxsize)
-        b = bytearray(len)
-        self.readinto(b)
-        self.append(b)
+        if self._budgeted:
+            self._charge(len, "BYTEARRAY8")
+        self.append(self._read_payload(len, self._read_bytearray))
     dispatch[BYTEARRAY8[0]] = load_bytearray8
 
+    def _read_bytearray(self, n):
+        b = bytearray(n)
+        self.readinto(b)
+        return b
+
+    def _read_payload(self, n, read):
+        # Read a payload of n bytes into a buffer from the allocator if it is
+        # large enough to have been written outside of a frame.
+        if self._allocator is None or n < _Framer._FRAME_SIZE_TARGET:
+            return read(n)
+        buf = self._allocator(n)
+        with memoryview(buf) as m:
+            if m.nbytes != n:
+                raise UnpicklingError("allocator returned a buffer of %d "
+                                      "bytes instead of %d" % (m.nbytes, n))
+        self.readinto(buf)
+        return buf
+
     def load_next_buffer(self):
         if self._buffers is None:
             raise UnpicklingError("pickle stream refers to out-of-band data "
@@ -1413,17 +3090,23 @@ class _Unpickler:
 
     def load_short_binstring(self):
         len = self.read(1)[0]
+        if self._budgeted:
+            self._charge(len, "SHORT_BINSTRING")
         data = self.read(len)
         self.append(self._decode_string(data))
     dispatch[SHORT_BINSTRING[0]] = load_short_binstring
 
     def load_short_binbytes(self):
         len = self.read(1)[0]
+        if self._budgeted:
+            self._charge(len, "SHORT_BINBYTES")
         self.append(self.read(len))
     dispatch[SHORT_BINBYTES[0]] = load_short_binbytes
 
     def load_short_binunicode(self):
         len = self.read(1)[0]
+        if self._budgeted:
+            self._charge(len, "SHORT_BINUNICODE")
         self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
     dispatch[SHORT_BINUNICODE[0]] = load_short_binunicode
 
@@ -1747,9 +3430,11 @@ class _Unpickler:
 
 # Shorthands
 
-def _dump(obj, file, protocol=None, *, fix_imports=True, buffer_callback=None):
+def _dump(obj, file, protocol=None, *, fix_imports=True, buffer_callback=None,
+          writebehind=0):
     _Pickler(file, protocol, fix_imports=fix_imports,
-             buffer_callback=buffer_callback).dump(obj)
+             buffer_callback=buffer_callback,
+             writebehind=writebehind).dump(obj)
 
 def _dumps(obj, protocol=None, *, fix_imports=True, buffer_callback=None):
     f = io.BytesIO()
@@ -1760,17 +3445,1476 @@ def _dumps(obj, protocol=None, *, fix_imports=True, buffer_callback=None):
     return res
 
 def _load(file, *, fix_imports=True, encoding="ASCII", errors="strict",
-          buffers=None):
+          buffers=None, readahead=0, buffered=None, use_mmap=False,
+          zero_copy=False, allocator=None):
     return _Unpickler(file, fix_imports=fix_imports, buffers=buffers,
-                     encoding=encoding, errors=errors).load()
+                     encoding=encoding, errors=errors,
+                     readahead=readahead, buffered=buffered,
+                     use_mmap=use_mmap, zero_copy=zero_copy,
+                     allocator=allocator).load()
 
 def _loads(s, /, *, fix_imports=True, encoding="ASCII", errors="strict",
-           buffers=None):
+           buffers=None, allocator=None):
     if isinstance(s, str):
         raise TypeError("Can't load pickle from unicode string")
     file = io.BytesIO(s)
     return _Unpickler(file, fix_imports=fix_imports, buffers=buffers,
-                      encoding=encoding, errors=errors).load()
+                      encoding=encoding, errors=errors,
+                      allocator=allocator).load()
+
+# In-process roundtrips
+
+class _RoundTrip(_Pickler):
+
+    # A Pickler that builds the objects it pickles with an _Unpickler as it
+    # goes.  The values of ints, floats, strings and bytes are pushed onto
+    # the unpickler's stack instead of being encoded, and so is every memo
+    # entry.  All other opcodes, which carry no payload, are executed by the
+    # unpickler's load_*() methods as soon as they are written.
+
+    def __init__(self, protocol, fix_imports):
+        super().__init__(io.BytesIO(), protocol, fix_imports=fix_imports)
+        self.write = self._execute
+        u = self._unpickler = _Unpickler(io.BytesIO(), fix_imports=fix_imports)
+        u.metastack = []
+        u.stack = []
+        u.append = u.stack.append
+        u.proto = self.proto
+        u._total_bytes = 0
+
+    def clone(self, obj):
+        """Return the object that loading the pickle of obj would build."""
+        self.save(obj)
+        return self._unpickler.stack.pop()
+
+    def _execute(self, data):
+        # Run the opcodes in data on the unpickler
+        u = self._unpickler
+        if len(data) == 1:
+            u.dispatch[data[0]](u)
+            return
+        f = io.BytesIO(data)
+        read = u.read = u.readview = u._read_bytes = f.read
+        u.readline = f.readline
+        key = read(1)
+        while key:
+            u.dispatch[key[0]](u)
+            key = read(1)
+
+    def memoize(self, obj):
+        if self.fast:
+            return
+        idx = len(self.memo)
+        self.memo[id(obj)] = idx, obj
+        u = self._unpickler
+        u.memo[idx] = u.stack[-1]
+
+    def save(self, obj, save_persistent_id=True):
+        x = self.memo.get(id(obj))
+        if x is not None:
+            u = self._unpickler
+            u.append(u.memo[x[0]])
+            return
+        super().save(obj, save_persistent_id)
+
+    dispatch = _Pickler.dispatch.copy()
+
+    # Immutable values are shared with the original, as in copy.deepcopy()
+
+    def save_value(self, obj):
+        self._unpickler.append(obj)
+    dispatch[type(None)] = save_value
+    dispatch[bool] = save_value
+    dispatch[int] = save_value
+    dispatch[float] = save_value
+
+    def save_str(self, obj):
+        self._unpickler.append(obj)
+        if not self.bin:
+            # Protocol 0 memoizes the escaped copy, see _Pickler.save_str()
+            obj = obj.replace("\\", "\\u005c")
+            obj = obj.replace("\0", "\\u0000")
+            obj = obj.replace("\n", "\\u000a")
+            obj = obj.replace("\r", "\\u000d")
+            obj = obj.replace("\x1a", "\\u001a")
+        self.memoize(obj)
+    dispatch[str] = save_str
+
+    def save_bytes(self, obj):
+        self._unpickler.append(obj)
+        self.memoize(obj)
+    dispatch[bytes] = save_bytes
+
+    def save_bytearray(self, obj):
+        self._unpickler.append(bytearray(obj))
+        self.memoize(obj)
+    dispatch[bytearray] = save_bytearray
+
+    def _write_bytes(self, data):
+        self._unpickler.append(bytes(data))
+
+    def _write_bytearray(self, data):
+        self._unpickler.append(bytearray(data))
+
+def roundtrip(obj, protocol=None, *, fix_imports=True):
+    """Return a copy of obj as loads(dumps(obj, protocol)) would build it.
+
+    The object is pickled with the given *protocol* and *fix_imports*, and
+    reduce(), __setstate__(), shared references and cycles are handled as
+    in a real roundtrip, but nothing is encoded or decoded: objects are
+    rebuilt by the Unpickler logic as the Pickler walks obj.  Ints, floats,
+    strings and bytes are not copied, which loads() would do, as they are
+    immutable.
+    """
+    return _RoundTrip(protocol, fix_imports).clone(obj)
+
+# Shared dictionaries
+
+class SharedDictionary:
+    """A versioned table of objects that both ends of a stream of pickles
+    agree on.
+
+    SharedDictionaryPickler writes a reference of a few bytes to an entry
+    instead of pickling it, as a persistent id, and SharedDictionaryUnpickler
+    turns the reference back into the entry.  Strings are matched by value
+    and other objects, typically classes and functions, by identity.  None,
+    bools and ints are never referred to, as their own opcodes are no
+    larger than a reference.  The dictionary pickles as its entries and
+    version, so that it can be sent once to the other end.
+    """
+
+    def __init__(self, objects, version=1):
+        self.objects = tuple(objects)
+        self.version = int(version)
+        self._strings = {}
+        self._ids = {}
+        for i, obj in enumerate(self.objects):
+            if type(obj) is str:
+                self._strings.setdefault(obj, i)
+            elif obj is not None and type(obj) not in (bool, int):
+                self._ids.setdefault(id(obj), i)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __reduce__(self):
+        return type(self), (self.objects, self.version)
+
+    def index(self, obj):
+        """Return the index of the entry for obj, or None."""
+        if type(obj) is str:
+            return self._strings.get(obj)
+        return self._ids.get(id(obj))
+
+    @classmethod
+    def train(cls, samples, size=256, version=1, protocol=None):
+        """Build a dictionary from representative objects.
+
+        Each of *samples* is pickled with *protocol*.  The strings, and
+        the classes and functions pickled by reference, that occur in two
+        samples or more are ranked by the number of bytes that references
+        to them would have saved, and the first *size* of them become the
+        entries.
+        """
+        trainer = _DictionaryTrainer(protocol)
+        for sample in samples:
+            trainer.count(sample)
+        ranked = sorted(trainer.counts, reverse=True,
+                        key=lambda key: (trainer.counts[key] - 1) *
+                                        (trainer.sizes[key] - 3))
+        objects = [trainer.objects[key] for key in ranked[:size]
+                   if trainer.counts[key] > 1 and trainer.sizes[key] > 3]
+        return cls(objects, version)
+
+class _DictionaryTrainer(_Pickler):
+
+    # Count the samples in which each candidate entry occurs, along with an
+    # estimate of the size of its opcodes.  Strings are keyed by value and
+    # globals by id.  Candidates are replaced by a dummy reference, so that
+    # the names of globals are not counted as strings of their own.
+
+    def __init__(self, protocol):
+        self.file = io.BytesIO()
+        super().__init__(self.file, protocol)
+        self.counts = {}
+        self.sizes = {}
+        self.objects = {}
+        self.seen = set()
+
+    def count(self, sample):
+        self.seen.clear()
+        self.clear_memo()
+        self.file.seek(0)
+        self.file.truncate()
+        self.dump(sample)
+
+    def persistent_id(self, obj):
+        t = type(obj)
+        if t is str:
+            key = obj
+            size = len(obj) + 2
+        elif (t in (FunctionType, BuiltinFunctionType) or
+                isinstance(obj, type)):
+            key = id(obj)
+            size = (len(getattr(obj, "__module__", None) or "") +
+                    len(getattr(obj, "__qualname__", "")) + 4)
+        else:
+            return None
+        if key not in self.seen:
+            self.seen.add(key)
+            if key in self.counts:
+                self.counts[key] += 1
+            else:
+                self.counts[key] = 1
+                self.sizes[key] = size
+                self.objects[key] = obj
+        return 0
+
+class SharedDictionaryPickler(_Pickler):
+    """Pickler that refers to the entries of a SharedDictionary.
+
+    The first reference of each pickle also carries the version of the
+    dictionary.  References are ints, or strings with protocol 0.  Other
+    arguments are the same as for Pickler.
+    """
+
+    def __init__(self, file, dictionary, protocol=None, *, fix_imports=True,
+                 buffer_callback=None, writebehind=0):
+        super().__init__(file, protocol, fix_imports=fix_imports,
+                         buffer_callback=buffer_callback,
+                         writebehind=writebehind)
+        self.dictionary = dictionary
+        self._versioned = False
+
+    def dump(self, obj):
+        """Write a pickled representation of obj to the open file."""
+        self._versioned = False
+        super().dump(obj)
+
+    def persistent_id(self, obj):
+        i = self.dictionary.index(obj)
+        if i is None:
+            return None
+        if not self._versioned:
+            self._versioned = True
+            if not self.bin:
+                return "%d:%d" % (self.dictionary.version, i)
+            return self.dictionary.version, i
+        return i if self.bin else str(i)
+
+class SharedDictionaryUnpickler(_Unpickler):
+    """Unpickler for pickles written by SharedDictionaryPickler.
+
+    An UnpicklingError is raised if a pickle refers to another version of
+    the dictionary or to an entry it does not have.  Other arguments are
+    the same as for Unpickler.
+    """
+
+    def __init__(self, file, dictionary, **kwargs):
+        super().__init__(file, **kwargs)
+        self.dictionary = dictionary
+        self._versioned = False
+
+    def load(self):
+        """Read a pickled object representation from the open file.
+
+        Return the reconstituted object hierarchy specified in the file.
+        """
+        self._versioned = False
+        return super().load()
+
+    def persistent_load(self, pid):
+        if type(pid) is str:
+            # Protocol 0
+            version, sep, i = pid.partition(":")
+            try:
+                pid = (int(version), int(i)) if sep else int(version)
+            except ValueError:
+                raise UnpicklingError("unsupported persistent id encountered")
+        if type(pid) is tuple and len(pid) == 2 and not self._versioned:
+            version, pid = pid
+            if version != self.dictionary.version:
+                raise UnpicklingError(
+                    "pickle needs version %r of the shared dictionary, "
+                    "not %d" % (version, self.dictionary.version))
+            self._versioned = True
+        elif not self._versioned:
+            raise UnpicklingError("shared dictionary reference without "
+                                  "a version")
+        if type(pid) is not int or not 0 <= pid < len(self.dictionary):
+            raise UnpicklingError("shared dictionary has no entry %r" % (pid,))
+        return self.dictionary.objects[pid]
+
+# Sessions
+
+def _renumber_memo(recent, keep):
+    # Map the memo indices of the keep most recently used entries, given by
+    # recent from least to most recently used, to 0 ... keep - 1 in the
+    # order of their indices.  Both ends of a session cut their memo down
+    # this way, so that new entries can take the next free index again.
+    survivors = sorted(list(recent)[len(recent) - keep:])
+    return {old: new for new, old in enumerate(survivors)}
+
+class SessionPickler(_Pickler):
+    """Pickler for a stream of messages that may refer to earlier ones.
+
+    The memo is kept from one dump() to the next, so that an object that
+    was pickled by an earlier message is sent as a memo reference.  Like
+    with any reused Pickler, such an object must not change in between.
+    If *memo_size* is not None, the memo is cut down at the end of any
+    message that leaves more than *memo_size* entries: only the
+    memo_size // 2 most recently written or referenced ones are kept.
+    SessionUnpickler, given the same *memo_size*, does the same.  Other
+    arguments are the same as for Pickler.
+    """
+
+    def __init__(self, file, protocol=None, *, fix_imports=True,
+                 buffer_callback=None, writebehind=0, memo_size=None):
+        super().__init__(file, protocol, fix_imports=fix_imports,
+                         buffer_callback=buffer_callback,
+                         writebehind=writebehind)
+        self.memo_size = memo_size
+        self._recent = {}
+
+    def clear_memo(self):
+        super().clear_memo()
+        self._recent.clear()
+
+    def dump(self, obj):
+        """Write a pickled representation of obj to the open file."""
+        super().dump(obj)
+        if self.memo_size is not None and len(self.memo) > self.memo_size:
+            renumber = _renumber_memo(self._recent, self.memo_size // 2)
+            self.memo = {key: (renumber[i], obj)
+                         for key, (i, obj) in self.memo.items()
+                         if i in renumber}
+            self._recent = {renumber[i]: None for i in self._recent
+                            if i in renumber}
+
+    def put(self, idx):
+        recent = self._recent
+        recent.pop(idx, None)
+        recent[idx] = None
+        return super().put(idx)
+
+    def get(self, i):
+        recent = self._recent
+        recent.pop(i, None)
+        recent[i] = None
+        return super().get(i)
+
+class _SessionMemo(dict):
+
+    # Unpickler memo that keeps track of the order in which its entries are
+    # stored and fetched, least recently used first, in self.recent
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.recent = dict.fromkeys(self)
+
+    def __getitem__(self, i):
+        value = dict.__getitem__(self, i)
+        recent = self.recent
+        del recent[i]
+        recent[i] = None
+        return value
+
+    def __setitem__(self, i, value):
+        dict.__setitem__(self, i, value)
+        recent = self.recent
+        recent.pop(i, None)
+        recent[i] = None
+
+class SessionUnpickler(_Unpickler):
+    """Unpickler for the messages written by a SessionPickler.
+
+    The memo is kept from one load() to the next.  *memo_size* must be the
+    same as that of the SessionPickler.  Other arguments are the same as
+    for Unpickler.
+    """
+
+    def __init__(self, file, *, memo_size=None, **kwargs):
+        super().__init__(file, **kwargs)
+        self.memo_size = memo_size
+        self.memo = _SessionMemo()
+
+    def load(self):
+        """Read a pickled object representation from the open file.
+
+        Return the reconstituted object hierarchy specified in the file.
+        """
+        obj = super().load()
+        memo = self.memo
+        if self.memo_size is not None and len(memo) > self.memo_size:
+            renumber = _renumber_memo(memo.recent, self.memo_size // 2)
+            self.memo = _SessionMemo(
+                (renumber[i], dict.__getitem__(memo, i)) for i in memo.recent
+                if i in renumber)
+        return obj
+
+# Extension code registries
+
+class ExtensionRegistry:
+    """A set of extension codes for globals, kept in a versioned file.
+
+    Pickles written with protocol 2 or more refer to a registered global
+    with an EXT1, EXT2 or EXT4 opcode of 2 to 5 bytes instead of its module
+    and qualified name, and the Unpickler fetches it without an import.
+    *codes* maps (module, qualified name) pairs to codes.  Both ends of a
+    stream must install() the same registry, or a later revision of it:
+    train() never changes a code once it has been assigned.
+    """
+
+    _FORMAT = 1
+
+    def __init__(self, codes=None, version=1):
+        self.codes = dict(codes or {})
+        self.version = int(version)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def train(cls, samples, previous=None, start=240, size=256,
+              protocol=None):
+        """Assign extension codes to the globals used by *samples*.
+
+        Each sample is pickled with *protocol*.  The globals referred to
+        by two samples or more, and not in *previous*, get codes from
+        *start* up in order of decreasing use, at most *size* of them, and
+        skipping codes that *previous* or copyreg already use.  Globals
+        that copyreg already has a code for keep it.  The codes of
+        *previous* are kept, and the version is one more than its own if
+        any code is added.
+        """
+        profiler = _GlobalProfiler(protocol)
+        for sample in samples:
+            profiler.count(sample)
+        codes = dict(previous.codes) if previous is not None else {}
+        version = previous.version if previous is not None else 1
+        used = set(codes.values())
+        used.update(_inverted_registry)
+        new = sorted((key for key, n in profiler.counts.items()
+                      if n > 1 and key not in codes),
+                     key=profiler.counts.get, reverse=True)[:size]
+        code = start
+        for key in new:
+            if key in _extension_registry:
+                # Registered by someone else already
+                codes[key] = _extension_registry[key]
+                continue
+            while code in used:
+                code += 1
+            if code > 0x7fffffff:
+                raise ValueError("no extension code left for %s.%s" % key)
+            codes[key] = code
+            used.add(code)
+        if new and previous is not None:
+            version += 1
+        return cls(codes, version)
+
+    def install(self):
+        """Register the codes with copyreg.add_extension()."""
+        import copyreg
+        for (module, name), code in self.codes.items():
+            if _extension_registry.get((module, name)) != code:
+                copyreg.add_extension(module, name, code)
+
+    def uninstall(self):
+        """Remove the codes that install() registered."""
+        import copyreg
+        for (module, name), code in self.codes.items():
+            if _extension_registry.get((module, name)) == code:
+                copyreg.remove_extension(module, name, code)
+
+    def save(self, path):
+        """Write the registry to the JSON file *path*."""
+        import json
+        # One entry per line, in order of code, to keep diffs readable
+        entries = sorted([code, module, name]
+                         for (module, name), code in self.codes.items())
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"format": %d, "version": %d, "extensions": [\n'
+                    % (self._FORMAT, self.version))
+            f.write(",\n".join(json.dumps([module, name, code])
+                                for code, module, name in entries))
+            f.write("\n]}\n")
+
+    @classmethod
+    def load(cls, path):
+        """Read a registry written by save().
+
+        A ValueError is raised if the file is not in a format this version
+        of the module can read.
+        """
+        import json
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get("format") != cls._FORMAT:
+            raise ValueError("%s is not an extension registry of format %d"
+                             % (path, cls._FORMAT))
+        return cls({(module, name): code
+                    for module, name, code in data["extensions"]},
+                   data["version"])
+
+class _GlobalProfiler(_Pickler):
+
+    # Count the samples that refer to each global, by the (module, name)
+    # key of the extension registry.  Globals are saved as usual, so that
+    # only their first reference in a sample reaches save_global().
+
+    def __init__(self, protocol):
+        self.file = io.BytesIO()
+        super().__init__(self.file, protocol)
+        self.counts = {}
+        self.seen = set()
+
+    def count(self, sample):
+        self.seen.clear()
+        self.clear_memo()
+        self.file.seek(0)
+        self.file.truncate()
+        self.dump(sample)
+
+    def save_global(self, obj, name=None):
+        if name is None:
+            name = getattr(obj, '__qualname__', None)
+        if name is None:
+            name = obj.__name__
+        key = whichmodule(obj, name), name
+        if key not in self.seen:
+            self.seen.add(key)
+            self.counts[key] = self.counts.get(key, 0) + 1
+        super().save_global(obj, name)
+
+    dispatch = _Pickler.dispatch.copy()
+    dispatch[FunctionType] = save_global
+
+# Asyncio stream shorthands
+
+class _AsyncStreamWriter:
+
+    # File object handed to a _Pickler running in a worker thread.  Writes
+    # are collected until a frame's worth of data is pending, then passed to
+    # the event loop in one go; the pickler thread waits for writer.drain()
+    # so that a slow peer applies backpressure to the encoder.  *submit*
+    # runs a coroutine on the event loop and returns its future.
+
+    def __init__(self, writer, submit):
+        self.writer = writer
+        self.submit = submit
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        n = len(data)
+        self.chunks.append(data)
+        self.size += n
+        if self.size >= _Framer._FRAME_SIZE_TARGET:
+            self.flush()
+        return n
+
+    def flush(self):
+        if self.chunks:
+            chunks = self.chunks
+            self.chunks = []
+            self.size = 0
+            self.submit(self._send(chunks)).result()
+
+    async def _send(self, chunks):
+        write = self.writer.write
+        for chunk in chunks:
+            write(chunk)
+        await self.writer.drain()
+
+
+class _AsyncStreamReader:
+
+    # File object handed to an _Unpickler running in a worker thread, which
+    # reads it through a _ReadBuffer.  read1() returns whatever the reader
+    # has available, up to a whole chunk, so that opcodes are decoded from
+    # the buffer rather than with one round trip to the event loop each.
+    # The bytes given in *pending*, left over by the previous load_async(),
+    # are read first.
+
+    def __init__(self, reader, submit, pending=b''):
+        self.reader = reader
+        self.submit = submit
+        self.pending = pending
+
+    def read(self, n):
+        return self._read_pending(n) or self.submit(self._read(n)).result()
+
+    def read1(self, n):
+        return (self._read_pending(n) or
+                self.submit(self.reader.read(n)).result())
+
+    def _read_pending(self, n):
+        data = self.pending[:n]
+        self.pending = self.pending[n:]
+        return data
+
+    async def _read(self, n):
+        # Like readexactly(), but returning a short read at the end of the
+        # stream.
+        chunks = []
+        while n:
+            chunk = await self.reader.read(n)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+# Bytes that load_async() read past the end of a pickle, by StreamReader
+_async_remainders = WeakKeyDictionary()
+
+async def dump_async(obj, writer, protocol=None, *, fix_imports=True,
+                     buffer_callback=None):
+    """Write a pickled representation of obj to an asyncio StreamWriter.
+
+    Encoding runs in the loop's default executor; frames are written to
+    *writer* as they are committed and writer.drain() is awaited after
+    each one, so the event loop is never blocked by a large object.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    file = _AsyncStreamWriter(
+        writer, partial(asyncio.run_coroutine_threadsafe, loop=loop))
+
+    def dump():
+        _Pickler(file, protocol, fix_imports=fix_imports,
+                 buffer_callback=buffer_callback).dump(obj)
+        file.flush()
+
+    await loop.run_in_executor(None, dump)
+
+async def load_async(reader, *, fix_imports=True, encoding="ASCII",
+                     errors="strict", buffers=None):
+    """Read a pickled object representation from an asyncio StreamReader.
+
+    Decoding runs in the loop's default executor.  The stream is read in
+    chunks of whatever data is available; bytes received past the end of
+    the pickle are kept for the next load_async() call on the same
+    *reader*, so further messages on the stream are not lost as long as
+    they are read with load_async().
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    file = _AsyncStreamReader(
+        reader, partial(asyncio.run_coroutine_threadsafe, loop=loop),
+        _async_remainders.pop(reader, b''))
+    unpickler = _Unpickler(file, fix_imports=fix_imports, buffers=buffers,
+                           encoding=encoding, errors=errors, buffered=True)
+    try:
+        return await loop.run_in_executor(None, unpickler.load)
+    finally:
+        rest = unpickler.remainder + file.pending
+        if rest:
+            _async_remainders[reader] = rest
+
+# Out-of-band buffer transports
+
+# Buffers are laid out at multiples of this offset, so that each one starts
+# on its own cache line.
+_BUFFER_ALIGNMENT = 64
+
+def _dumps_collecting_buffers(obj, protocol, fix_imports):
+    # Pickle obj with every PickleBuffer sent out-of-band; return the pickle
+    # and the raw views of the buffers, in the order load expects them.
+    if protocol is None or protocol < 0:
+        protocol = HIGHEST_PROTOCOL
+    views = []
+
+    def collect(buf):
+        views.append(buf.raw())
+        return False
+
+    data = _dumps(obj, protocol, fix_imports=fix_imports,
+                  buffer_callback=collect)
+    return data, views
+
+def _layout_buffers(views, start=0):
+    # Return a list of (offset, nbytes, readonly) entries for views packed
+    # from offset start at _BUFFER_ALIGNMENT, and the total size.
+    layout = []
+    offset = start
+    for view in views:
+        offset = -(-offset // _BUFFER_ALIGNMENT) * _BUFFER_ALIGNMENT
+        layout.append((offset, view.nbytes, view.readonly))
+        offset += view.nbytes
+    return layout, offset
+
+def _shared_mapping(shm):
+    # Return a memoryview of the whole of shm that keeps shm alive.  The
+    # view is taken through a ctypes array at the address of the mapping,
+    # which holds a reference to shm but exports nothing from it, so that
+    # shm is closed, and unmapped, only once the last view is released.
+    import ctypes
+    address = ctypes.addressof(ctypes.c_char.from_buffer(shm.buf))
+    holder = (ctypes.c_char * len(shm.buf)).from_address(address)
+    holder.shm = shm
+    return memoryview(holder).cast("B")
+
+def dumps_shared(obj, protocol=None, *, fix_imports=True):
+    """Pickle obj, moving its out-of-band buffers into shared memory.
+
+    Every PickleBuffer reached while pickling is copied into a single
+    multiprocessing.shared_memory segment instead of the pickle stream.
+    Return a tuple (data, segment) of the pickle bytes and a small
+    picklable descriptor of the segment, or None if no buffer was seen.
+    Both are meant to be passed to loads_shared() in another process,
+    which takes ownership of the segment.  *protocol* must be 5 or more.
+
+    The segment outlives this function only where shared memory is named
+    in the file system, so this is not available on Windows, which frees
+    a segment with its last handle: NotImplementedError is raised there
+    if obj has any out-of-band buffer.
+    """
+    data, views = _dumps_collecting_buffers(obj, protocol, fix_imports)
+    if not views:
+        return data, None
+    if sys.platform == "win32":
+        raise NotImplementedError("dumps_shared() needs POSIX shared memory")
+    from multiprocessing import shared_memory
+    layout, size = _layout_buffers(views)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        for view, (offset, nbytes, readonly) in zip(views, layout):
+            shm.buf[offset:offset + nbytes] = view
+    finally:
+        shm.close()
+    return data, (shm.name, tuple(layout))
+
+def loads_shared(data, segment, *, fix_imports=True, encoding="ASCII",
+                 errors="strict", unlink=True):
+    """Load a pickle written by dumps_shared().
+
+    The out-of-band buffers are rebuilt as memoryviews over the shared
+    memory segment, without copying; read-only buffers come back as
+    read-only views.  The segment stays mapped for as long as any view
+    is alive.  If *unlink* is true (the default), the segment name is
+    removed once it is attached, so that it is freed with the last view.
+    """
+    buffers = []
+    if segment is not None:
+        from multiprocessing import shared_memory
+        name, layout = segment
+        shm = shared_memory.SharedMemory(name)
+        if unlink:
+            shm.unlink()
+        mapping = _shared_mapping(shm)
+        for offset, nbytes, readonly in layout:
+            view = mapping[offset:offset + nbytes]
+            buffers.append(view.toreadonly() if readonly else view)
+    return _loads(data, fix_imports=fix_imports, encoding=encoding,
+                  errors=errors, buffers=buffers)
+
+# A sidecar file starts with this magic and the number of buffers, followed
+# by one (offset, nbytes, flags) entry per buffer.  The buffers themselves
+# come after the index, each at an offset from the start of the file that is
+# a multiple of _BUFFER_ALIGNMENT.
+_SIDECAR_MAGIC = b"PKLBUF\x00\x01"
+_SIDECAR_HEADER = "<8sQ"
+_SIDECAR_ENTRY = "<QQQ"
+_SIDECAR_READONLY = 1
+
+def _sidecar_path(path, sidecar):
+    import os
+    if sidecar is None:
+        sidecar = os.fspath(path) + ".buffers"
+    return sidecar
+
+def dump_with_sidecar(obj, path, protocol=None, *, fix_imports=True,
+                      sidecar=None):
+    """Pickle obj to the file *path*, and its buffers to a sidecar file.
+
+    Every PickleBuffer reached while pickling is written out-of-band to
+    *sidecar* (by default *path* with ".buffers" appended), aligned so
+    that load_with_sidecar() can map it back without copying.  The
+    sidecar is written even if there are no buffers.  *protocol* must be
+    5 or more.
+    """
+    data, views = _dumps_collecting_buffers(obj, protocol, fix_imports)
+    start = (calcsize(_SIDECAR_HEADER) +
+             calcsize(_SIDECAR_ENTRY) * len(views))
+    layout, _ = _layout_buffers(views, start)
+    with open(_sidecar_path(path, sidecar), "wb") as f:
+        f.write(pack(_SIDECAR_HEADER, _SIDECAR_MAGIC, len(views)))
+        for offset, nbytes, readonly in layout:
+            flags = _SIDECAR_READONLY if readonly else 0
+            f.write(pack(_SIDECAR_ENTRY, offset, nbytes, flags))
+        pos = start
+        for view, (offset, nbytes, readonly) in zip(views, layout):
+            f.write(bytes(offset - pos))
+            f.write(view)
+            pos = offset + nbytes
+    with open(path, "wb") as f:
+        f.write(data)
+
+def load_with_sidecar(path, *, fix_imports=True, encoding="ASCII",
+                      errors="strict", sidecar=None):
+    """Load a pickle written by dump_with_sidecar().
+
+    The sidecar file is memory-mapped copy-on-write and the out-of-band
+    buffers are passed to the unpickler as views of the mapping, so
+    reloading large buffers costs about as much as the mapping itself.
+    Writing to a writable buffer never changes the file.  Read-only
+    buffers come back as read-only views.
+    """
+    import mmap
+    import os
+    with open(_sidecar_path(path, sidecar), "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise UnpicklingError("sidecar file was truncated")
+        map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(map)     # The mapping is closed with its last view
+    header_size = calcsize(_SIDECAR_HEADER)
+    entry_size = calcsize(_SIDECAR_ENTRY)
+    if len(view) < header_size:
+        raise UnpicklingError("sidecar file was truncated")
+    magic, count = unpack(_SIDECAR_HEADER, view[:header_size])
+    if magic != _SIDECAR_MAGIC:
+        raise UnpicklingError("not a pickle sidecar file")
+    if header_size + entry_size * count > len(view):
+        raise UnpicklingError("sidecar file was truncated")
+    buffers = []
+    for offset, nbytes, flags in iter_unpack(
+            _SIDECAR_ENTRY,
+            view[header_size:header_size + entry_size * count]):
+        if offset + nbytes > len(view):
+            raise UnpicklingError("sidecar file was truncated")
+        buf = view[offset:offset + nbytes]
+        if flags & _SIDECAR_READONLY:
+            buf = buf.toreadonly()
+        buffers.append(buf)
+    with open(path, "rb") as f:
+        return _load(f, fix_imports=fix_imports, encoding=encoding,
+                     errors=errors, buffers=buffers)
+
+# Opcode scanning
+
+# Names of the one-byte opcodes, by code
+_OPCODE_NAMES = {value[0]: name for name, value in globals().items()
+                 if re.match("[A-Z][A-Z0-9_]+$", name) and
+                    isinstance(value, bytes) and len(value) == 1}
+
+# How the scanner reads the argument of each opcode: a kind and, for the
+# binary ones, the struct format of the argument or of its length prefix.
+_NO_ARG, _FIXED_ARG, _SIZED_ARG, _LINE_ARG, _NAME_ARG = range(5)
+_SCAN_LAYOUT = dict.fromkeys(_OPCODE_NAMES, (_NO_ARG, None, 0))
+_SCAN_LAYOUT.update({
+    code[0]: (_FIXED_ARG, Struct(fmt), width)
+    for code, fmt, width in [
+        (BININT, '<i', 4), (BININT1, '<B', 1), (BININT2, '<H', 2),
+        (BINFLOAT, '>d', 8), (BINGET, '<B', 1), (LONG_BINGET, '<I', 4),
+        (BINPUT, '<B', 1), (LONG_BINPUT, '<I', 4), (PROTO, '<B', 1),
+        (EXT1, '<B', 1), (EXT2, '<H', 2), (EXT4, '<i', 4),
+        (FRAME, '<Q', 8)]})
+_SCAN_LAYOUT.update({
+    code[0]: (_SIZED_ARG, Struct(fmt), width)
+    for code, fmt, width in [
+        (BINSTRING, '<i', 4), (SHORT_BINSTRING, '<B', 1),
+        (BINBYTES, '<I', 4), (SHORT_BINBYTES, '<B', 1),
+        (BINUNICODE, '<I', 4), (SHORT_BINUNICODE, '<B', 1),
+        (BINUNICODE8, '<Q', 8), (BINBYTES8, '<Q', 8),
+        (BYTEARRAY8, '<Q', 8), (LONG1, '<B', 1), (LONG4, '<i', 4)]})
+_SCAN_LAYOUT.update({
+    code[0]: (_LINE_ARG, None, 0)
+    for code in [INT, LONG, FLOAT, STRING, UNICODE, PERSID, GET, PUT]})
+_SCAN_LAYOUT.update({
+    code[0]: (_NAME_ARG, None, 0) for code in [GLOBAL, INST]})
+
+_MEMO_PUTS = frozenset(code[0] for code in [PUT, BINPUT, LONG_BINPUT, MEMOIZE])
+_MEMO_GETS = frozenset(code[0] for code in [GET, BINGET, LONG_BINGET])
+# Opcodes that do not simply push a value, as far as the scanner is concerned
+_SCAN_TRACKED = _MEMO_PUTS | _MEMO_GETS | {STACK_GLOBAL[0], STOP[0],
+                                           FRAME[0], PROTO[0]}
+# Untracked opcodes that pickle_stats() looks at
+_SCAN_STATS = frozenset([code for code, layout in _SCAN_LAYOUT.items()
+                         if layout[0] == _SIZED_ARG] + [GLOBAL[0], INST[0]])
+# Opcodes whose short payloads are decoded, for resolving STACK_GLOBAL
+_SCAN_STRINGS = frozenset([SHORT_BINUNICODE[0], BINUNICODE[0]])
+
+class _OpcodeScanner:
+
+    # Reads a pickle stream for scan_opcodes() in large chunks, and skips
+    # over payloads instead of reading them when the file is seekable.
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, file):
+        self.file = file
+        self.buf = b''
+        self.pos = 0
+        self.offset = 0     # Stream offset of buf[0]
+        self.end = None     # Stream offset of the end of a seekable file
+        if _seekable(file):
+            start = file.tell()
+            self.end = file.seek(0, io.SEEK_END) - start
+            file.seek(start)
+
+    def fill(self, n):
+        # Make at least n bytes available after pos, unless the file ends
+        # first; return whether it did.
+        pieces = [self.buf[self.pos:]]
+        have = len(pieces[0])
+        while have < n:
+            data = self.file.read(max(n - have, self._CHUNK_SIZE))
+            if not data:
+                break
+            pieces.append(data)
+            have += len(data)
+        self.offset += self.pos
+        self.buf = b''.join(pieces)
+        self.pos = 0
+        return have >= n
+
+    def read(self, n):
+        if len(self.buf) - self.pos < n and not self.fill(n):
+            raise UnpicklingError("pickle data was truncated")
+        pos = self.pos
+        self.pos = pos + n
+        return self.buf[pos:pos + n]
+
+    def readline(self):
+        end = self.buf.find(b'\n', self.pos)
+        while end < 0:
+            n = len(self.buf) - self.pos
+            if not self.fill(n + 1):
+                raise UnpicklingError("pickle data was truncated")
+            end = self.buf.find(b'\n', n)
+        pos = self.pos
+        self.pos = end + 1
+        return self.buf[pos:end]
+
+    def chunks(self, n):
+        # Generate the next n bytes in pieces of at most _CHUNK_SIZE.
+        while n:
+            if self.pos >= len(self.buf) and not self.fill(1):
+                raise UnpicklingError("pickle data was truncated")
+            data = self.read(min(n, len(self.buf) - self.pos,
+                                 self._CHUNK_SIZE))
+            n -= len(data)
+            yield data
+
+    def skip(self, n):
+        left = len(self.buf) - self.pos
+        if n <= left:
+            self.pos += n
+            return
+        n -= left
+        self.offset += len(self.buf)
+        self.buf = b''
+        self.pos = 0
+        if self.end is not None:
+            if self.offset + n > self.end:
+                raise UnpicklingError("pickle data was truncated")
+            self.file.seek(n, io.SEEK_CUR)
+            self.offset += n
+            return
+        while n:
+            data = self.file.read(min(n, self._CHUNK_SIZE))
+            if not data:
+                raise UnpicklingError("pickle data was truncated")
+            n -= len(data)
+            self.offset += len(data)
+
+def scan_opcodes(file):
+    """Generate the opcodes of the pickles in a binary file, without
+    building any object.
+
+    Each opcode is given as a tuple (name, arg, offset), where offset is
+    counted from the position of *file* when the scan started.  arg is
+    None for opcodes without argument, the integer or float argument of
+    fixed-size opcodes, the size in bytes of the payload of bytes, str
+    and long opcodes, and the memo index of memo opcodes, MEMOIZE
+    included.  GLOBAL, INST and STACK_GLOBAL give a (module, name)
+    tuple; for STACK_GLOBAL it is worked out from the strings pushed
+    before it as written by Pickler, and is None if they are not known.
+    Other text protocol opcodes give their argument line as bytes.
+    Payloads are skipped over rather than read when *file* is seekable.
+    Pickles following each other in *file* are all scanned.
+    """
+    return _scan_opcodes(file)
+
+def _scan_opcodes(file, counts=None):
+    # The generator behind scan_opcodes().  If counts is a list, it is
+    # used as a histogram indexed by opcode, and only the opcodes that
+    # pickle_stats() needs are generated.
+    scanner = _OpcodeScanner(file)
+    names = _OPCODE_NAMES
+    layouts = _SCAN_LAYOUT
+    tracked = _SCAN_TRACKED
+    strings_ops = _SCAN_STRINGS
+    memo_puts = _MEMO_PUTS
+    memo_gets = _MEMO_GETS
+    sized_arg = _SIZED_ARG
+    untracked_stats = _SCAN_STATS
+    memoize = MEMOIZE[0]
+    memo_len = 0
+    strings = {}        # Memo index -> str, for resolving STACK_GLOBAL
+    prev = last = None  # The last two values pushed, if known
+    inside = False      # Whether a pickle has started but not stopped
+    buf = scanner.buf
+    pos = base = end = 0
+    while True:
+        if pos >= end:
+            scanner.pos = pos
+            if not scanner.fill(1):
+                if inside:
+                    raise UnpicklingError("pickle data was truncated")
+                return
+            buf, pos, base = scanner.buf, 0, scanner.offset
+            end = len(buf)
+        code = buf[pos]
+        pos += 1
+        inside = True
+        try:
+            kind, st, width = layouts[code]
+        except KeyError:
+            raise UnpicklingError("invalid load key, %r at offset %d."
+                                  % (bytes([code]), base + pos - 1)) from None
+        value = arg = None
+        if st is not None:
+            if end - pos < width:
+                scanner.pos = pos
+                if not scanner.fill(width):
+                    raise UnpicklingError("pickle data was truncated")
+                buf, pos, base = scanner.buf, 0, scanner.offset
+                end = len(buf)
+            arg, = st.unpack_from(buf, pos)
+            pos += width
+            if kind == sized_arg:
+                if arg < 0:
+                    raise UnpicklingError("negative byte count at offset %d"
+                                          % (base + pos - width - 1))
+                if arg <= 0xff and code in strings_ops:
+                    if end - pos < arg:
+                        scanner.pos = pos
+                        if not scanner.fill(arg):
+                            raise UnpicklingError("pickle data was truncated")
+                        buf, pos, base = scanner.buf, 0, scanner.offset
+                        end = len(buf)
+                    value = str(buf[pos:pos + arg], 'utf-8', 'surrogatepass')
+                    pos += arg
+                elif end - pos >= arg:
+                    pos += arg
+                else:
+                    scanner.pos = pos
+                    scanner.skip(arg)
+                    buf, pos, base = scanner.buf, scanner.pos, scanner.offset
+                    end = len(buf)
+                offset = base + pos - arg - width - 1
+            else:
+                offset = base + pos - width - 1
+        elif kind:
+            # Text arguments may straddle a refill, so take the offset first.
+            offset = base + pos - 1
+            scanner.pos = pos
+            arg = scanner.readline()
+            if kind == _NAME_ARG:
+                arg = (arg.decode("utf-8"),
+                       scanner.readline().decode("utf-8"))
+            elif code == GET[0] or code == PUT[0]:
+                arg = int(arg)
+            buf, pos, base = scanner.buf, scanner.pos, scanner.offset
+            end = len(buf)
+        else:
+            offset = base + pos - 1
+
+        if counts is not None:
+            counts[code] += 1
+        if code not in tracked:
+            prev, last = last, value
+            if counts is not None and code not in untracked_stats:
+                continue
+        elif code in memo_puts:
+            if code == memoize:
+                arg = memo_len
+            strings[arg] = last
+            if arg >= memo_len:
+                memo_len = arg + 1
+        elif code in memo_gets:
+            prev, last = last, strings.get(arg)
+        elif code == STACK_GLOBAL[0]:
+            if isinstance(prev, str) and isinstance(last, str):
+                arg = (prev, last)
+            prev = last = None
+        elif code == STOP[0]:
+            memo_len = 0
+            strings = {}
+            prev = last = None
+            inside = False
+        yield names[code], arg, offset
+
+def pickle_stats(file, top=10):
+    """Return statistics about the pickles in a binary file.
+
+    The file is walked with scan_opcodes(), so no object is built and
+    payloads are not read.  The result is a dict with the keys
+
+    pickles     the number of pickles in the file
+    size        the number of bytes up to the end of the last pickle
+    protocol    the highest protocol given by a PROTO opcode, or 0
+    opcodes     a dict of opcode names to counts, most frequent first
+    frames      a dict with the number of frames, their total size in
+                bytes and the size of the largest one
+    memo        a dict with the number of entries stored, the largest
+                memo size reached by a pickle and the number of gets
+    payloads    a list of the *top* largest payloads, as (size, opcode
+                name, offset) tuples, largest first
+    globals     a dict of (module, name) tuples to the list of offsets
+                at which they are referenced
+    """
+    import heapq
+    sized = {_OPCODE_NAMES[code] for code, layout in _SCAN_LAYOUT.items()
+             if layout[0] == _SIZED_ARG}
+    counts = [0] * 256
+    frames = {"count": 0, "bytes": 0, "max": 0}
+    memo = {"entries": 0, "max": 0, "gets": 0}
+    payloads = []
+    refs = {}
+    pickles = protocol = size = memo_len = 0
+    for name, arg, offset in _scan_opcodes(file, counts):
+        if name in sized:
+            if len(payloads) < top:
+                heapq.heappush(payloads, (arg, name, offset))
+            elif payloads and arg > payloads[0][0]:
+                heapq.heapreplace(payloads, (arg, name, offset))
+        elif name == "FRAME":
+            frames["count"] += 1
+            frames["bytes"] += arg
+            frames["max"] = max(frames["max"], arg)
+        elif name in ("PUT", "BINPUT", "LONG_BINPUT", "MEMOIZE"):
+            memo["entries"] += 1
+            memo_len = max(memo_len, arg + 1)
+        elif name in ("GET", "BINGET", "LONG_BINGET"):
+            memo["gets"] += 1
+        elif name in ("GLOBAL", "INST", "STACK_GLOBAL") and arg is not None:
+            refs.setdefault(arg, []).append(offset)
+        elif name == "PROTO":
+            protocol = max(protocol, arg)
+        elif name == "STOP":
+            pickles += 1
+            memo["max"] = max(memo["max"], memo_len)
+            memo_len = 0
+            size = offset + 1
+    return {
+        "pickles": pickles,
+        "size": size,
+        "protocol": protocol,
+        "opcodes": {_OPCODE_NAMES[code]: count for count, code in
+                    sorted(((count, code) for code, count in enumerate(counts)
+                            if count), key=lambda item: -item[0])},
+        "frames": frames,
+        "memo": memo,
+        "payloads": sorted(payloads, reverse=True),
+        "globals": refs,
+    }
+
+# Protocol transcoding
+
+class _Transcoder:
+
+    # Rewrites the opcode stream of one pickle at a time for transcode().
+    # Input is read with an _OpcodeScanner and output is written through a
+    # _Framer, so that memory use is bounded by the size of a frame, a text
+    # line and the memo index map, however large the payloads are.
+
+    def __init__(self, infile, outfile, fix_imports):
+        self.scanner = _OpcodeScanner(infile)
+        self.framer = _Framer(outfile.write)
+        self.write = self.framer.write
+        self.fix_imports = fix_imports
+
+    def run(self):
+        scanner = self.scanner
+        while scanner.pos < len(scanner.buf) or scanner.fill(1):
+            self.transcode_pickle()
+
+    def transcode_pickle(self):
+        self.proto = 0          # The protocol the source is loaded with
+        self.memo = {}          # Source memo index -> output memo index
+        self.memoized = 0       # Size of the output memo
+        self.write(_PROTO_HEADERS[HIGHEST_PROTOCOL])
+        self.framer.start_framing()
+        read = self.scanner.read
+        dispatch = self.dispatch
+        while True:
+            code = read(1)[0]
+            try:
+                kind, st, width = _SCAN_LAYOUT[code]
+            except KeyError:
+                raise UnpicklingError("invalid load key, %r." %
+                                      bytes([code])) from None
+            if code in dispatch:
+                dispatch[code](self)
+            elif kind == _NO_ARG:
+                self.write(bytes([code]))
+            elif kind == _FIXED_ARG:
+                self.write(bytes([code]) + read(width))
+            else:
+                self.copy_payload(code, st, width)
+            if code == STOP[0]:
+                break
+            self.framer.commit_frame()
+        self.framer.end_framing()
+
+    def copy_payload(self, code, st, width):
+        header = self.scanner.read(width)
+        n, = st.unpack(header)
+        if n < 0:
+            raise UnpicklingError("%s pickle has negative byte count"
+                                  % _OPCODE_NAMES[code])
+        header = bytes([code]) + header
+        if n >= self.framer._FRAME_SIZE_TARGET:
+            self.framer.write_large_chunks(header, self.scanner.chunks(n))
+        else:
+            self.write(header + self.scanner.read(n))
+
+    def refuse(self, reason):
+        raise UnpicklingError("cannot transcode protocol %d pickle: %s"
+                              % (self.proto, reason))
+
+    def readline(self):
+        # The argument of a text opcode, as it is given to the decoder.
+        return self.scanner.readline()
+
+    def emit_int(self, value):
+        # As written by Pickler.save_long() for binary protocols.
+        if 0 <= value <= 0xff:
+            self.write(_BININT1_HEADERS[value])
+        elif 0 <= value <= 0xffff:
+            self.write(_pack_op_H(BININT2, value))
+        elif -0x80000000 <= value <= 0x7fffffff:
+            self.write(_pack_op_i(BININT, value))
+        else:
+            encoded = encode_long(value)
+            n = len(encoded)
+            if n < 256:
+                self.write(_LONG1_HEADERS[n] + encoded)
+            else:
+                self.write(_pack_op_i(LONG4, n) + encoded)
+
+    def emit_str(self, value):
+        # As written by Pickler.save_str() for protocol 4 and up.
+        encoded = value.encode('utf-8', 'surrogatepass')
+        n = len(encoded)
+        if n <= 0xff:
+            self.write(_SHORT_BINUNICODE_HEADERS[n] + encoded)
+        elif n > 0xffffffff:
+            self.framer.write_large_bytes(_pack_op_Q(BINUNICODE8, n),
+                                          encoded)
+        elif n >= self.framer._FRAME_SIZE_TARGET:
+            self.framer.write_large_bytes(_pack_op_I(BINUNICODE, n),
+                                          encoded)
+        else:
+            self.write(_pack_op_I(BINUNICODE, n) + encoded)
+
+    def resolve(self, module, name):
+        # Return the names that find_class() is given at protocol 5 for
+        # those given at self.proto, as the default find_class() sees them.
+        if self.proto < 3 and self.fix_imports:
+            if (module, name) in _compat_pickle.NAME_MAPPING:
+                module, name = _compat_pickle.NAME_MAPPING[(module, name)]
+            elif module in _compat_pickle.IMPORT_MAPPING:
+                module = _compat_pickle.IMPORT_MAPPING[module]
+        if self.proto < 4 and '.' in name:
+            self.refuse("dotted name %r would be looked up differently"
+                        % name)
+        return module, name
+
+    def put(self, index):
+        if index < 0:
+            raise ValueError("negative PUT argument")
+        # MEMOIZE stores at the current size of the output memo, which is
+        # the number of MEMOIZE written so far.  A source index that is put
+        # again maps to the new entry, as the old one can no longer be got.
+        self.memo[index] = self.memoized
+        self.memoized += 1
+        self.write(MEMOIZE)
+
+    def get(self, index):
+        try:
+            index = self.memo[index]
+        except KeyError:
+            self.refuse("memo key %d is not defined in this pickle" % index)
+        if index < 256:
+            self.write(_BINGET_HEADERS[index])
+        else:
+            self.write(_pack_op_I(LONG_BINGET, index))
+
+    dispatch = {}
+
+    def t_proto(self):
+        proto = self.scanner.read(1)[0]
+        if not 0 <= proto <= HIGHEST_PROTOCOL:
+            raise ValueError("unsupported pickle protocol: %d" % proto)
+        self.proto = proto
+    dispatch[PROTO[0]] = t_proto
+
+    def t_frame(self):
+        # Input frames are dropped; the output is framed anew.
+        self.scanner.read(8)
+    dispatch[FRAME[0]] = t_frame
+
+    def t_int(self):
+        data = self.readline()
+        if data == FALSE[1:-1]:
+            self.write(NEWFALSE)
+        elif data == TRUE[1:-1]:
+            self.write(NEWTRUE)
+        else:
+            self.emit_int(decode_decimal(data))
+    dispatch[INT[0]] = t_int
+
+    def t_long(self):
+        val = self.readline()
+        if val and val[-1] == b'L'[0]:
+            val = val[:-1]
+        self.emit_int(decode_decimal(val))
+    dispatch[LONG[0]] = t_long
+
+    def t_float(self):
+        self.write(BINFLOAT + pack('>d', float(self.readline())))
+    dispatch[FLOAT[0]] = t_float
+
+    def t_string(self):
+        # STRING and BINSTRING are decoded alike, according to the
+        # *encoding* of the Unpickler, so the bytes are kept as they are.
+        data = self.readline()
+        if len(data) >= 2 and data[0] == data[-1] and data[0] in b'"\'':
+            data = data[1:-1]
+        else:
+            raise UnpicklingError("the STRING opcode argument must be quoted")
+        data = codecs.escape_decode(data)[0]
+        n = len(data)
+        if n < 256:
+            self.write(_SHORT_BINSTRING_HEADERS[n] + data)
+        elif n <= 0x7fffffff:
+            self.write(_pack_op_i(BINSTRING, n) + data)
+        else:
+            self.refuse("STRING argument too long for BINSTRING")
+    dispatch[STRING[0]] = t_string
+
+    def t_unicode(self):
+        self.emit_str(str(self.readline(), 'raw-unicode-escape'))
+    dispatch[UNICODE[0]] = t_unicode
+
+    def t_persid(self):
+        try:
+            pid = self.readline().decode("ascii")
+        except UnicodeDecodeError:
+            raise UnpicklingError(
+                "persistent IDs in protocol 0 must be ASCII strings")
+        self.emit_str(pid)
+        self.write(BINPERSID)
+    dispatch[PERSID[0]] = t_persid
+
+    def t_global(self):
+        module = self.readline().decode("utf-8")
+        name = self.readline().decode("utf-8")
+        module, name = self.resolve(module, name)
+        self.emit_str(module)
+        self.emit_str(name)
+        self.write(STACK_GLOBAL)
+    dispatch[GLOBAL[0]] = t_global
+
+    def t_inst(self):
+        # INST has no binary counterpart; only its names are rewritten.
+        module = self.readline().decode("ascii")
+        name = self.readline().decode("ascii")
+        module, name = self.resolve(module, name)
+        self.write(INST + bytes(module, "utf-8") + b'\n' +
+                   bytes(name, "utf-8") + b'\n')
+    dispatch[INST[0]] = t_inst
+
+    def t_stack_global(self):
+        if self.proto < 4:
+            self.refuse("STACK_GLOBAL names are not known before loading")
+        self.write(STACK_GLOBAL)
+    dispatch[STACK_GLOBAL[0]] = t_stack_global
+
+    def check_extension(self, code):
+        # The extension registry is looked up when loading, but the names
+        # it gives there must not be found differently at protocol 5.
+        if self.proto >= 4:
+            return
+        key = _inverted_registry.get(code)
+        if key is None:
+            self.refuse("unregistered extension code %d" % code)
+        if self.resolve(*key) != key:
+            self.refuse("extension code %d would be looked up differently"
+                        % code)
+
+    def t_ext1(self):
+        arg = self.scanner.read(1)
+        self.check_extension(arg[0])
+        self.write(EXT1 + arg)
+    dispatch[EXT1[0]] = t_ext1
+
+    def t_ext2(self):
+        arg = self.scanner.read(2)
+        self.check_extension(unpack('<H', arg)[0])
+        self.write(EXT2 + arg)
+    dispatch[EXT2[0]] = t_ext2
+
+    def t_ext4(self):
+        arg = self.scanner.read(4)
+        self.check_extension(unpack('<i', arg)[0])
+        self.write(EXT4 + arg)
+    dispatch[EXT4[0]] = t_ext4
+
+    def t_get(self):
+        self.get(int(self.readline()))
+    dispatch[GET[0]] = t_get
+
+    def t_binget(self):
+        self.get(self.scanner.read(1)[0])
+    dispatch[BINGET[0]] = t_binget
+
+    def t_long_binget(self):
+        self.get(unpack('<I', self.scanner.read(4))[0])
+    dispatch[LONG_BINGET[0]] = t_long_binget
+
+    def t_put(self):
+        self.put(int(self.readline()))
+    dispatch[PUT[0]] = t_put
+
+    def t_binput(self):
+        self.put(self.scanner.read(1)[0])
+    dispatch[BINPUT[0]] = t_binput
+
+    def t_long_binput(self):
+        index, = unpack('<I', self.scanner.read(4))
+        if index > maxsize:
+            raise ValueError("negative LONG_BINPUT argument")
+        self.put(index)
+    dispatch[LONG_BINPUT[0]] = t_long_binput
+
+    def t_memoize(self):
+        self.put(len(self.memo))
+    dispatch[MEMOIZE[0]] = t_memoize
+
+def transcode(infile, outfile, *, fix_imports=True):
+    """Rewrite the pickles in a binary file as framed protocol 5 pickles.
+
+    The opcode stream of each pickle in *infile* is rewritten into
+    *outfile* without building any object, so that neither the classes
+    it refers to nor the memory for its objects are needed.  Text
+    opcodes are replaced by their binary counterparts, the memo is
+    renumbered for MEMOIZE, and the output is framed.  Payloads are
+    copied in bounded chunks.
+
+    The result loads to the same objects as the input does with the
+    default find_class() and the same *fix_imports*, *encoding* and
+    *errors*.  A pickle for which that cannot be guaranteed, such as one
+    with a dotted global name below protocol 4, is refused with an
+    UnpicklingError, as are malformed pickles.  Output written for
+    pickles that came before it is kept.
+    """
+    _Transcoder(infile, outfile, fix_imports).run()
 
 # Use the faster _pickle if possible
 try:
@@ -1807,12 +4951,48 @@ if __name__ == "__main__":
     parser.add_argument(
         '-v', action='store_true',
         help='run verbosely; only affects self-test run')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print statistics about the opcode stream instead of loading')
+    parser.add_argument(
+        '--scan', action='store_true',
+        help='list the opcodes of the stream instead of loading')
     args = parser.parse_args()
     if args.test:
         _test()
     else:
         if not args.pickle_file:
             parser.print_help()
+        elif args.scan:
+            for f in args.pickle_file:
+                for name, arg, offset in scan_opcodes(f):
+                    if arg is None:
+                        print("%10d: %s" % (offset, name))
+                    else:
+                        print("%10d: %-16s %r" % (offset, name, arg))
+        elif args.stats:
+            for f in args.pickle_file:
+                stats = pickle_stats(f)
+                print("%s: %d pickle(s), %d bytes, protocol %d"
+                      % (f.name, stats["pickles"], stats["size"],
+                         stats["protocol"]))
+                frames = stats["frames"]
+                print("  frames: %d, %d bytes, largest %d bytes"
+                      % (frames["count"], frames["bytes"], frames["max"]))
+                memo = stats["memo"]
+                print("  memo: %d entries, at most %d per pickle, %d gets"
+                      % (memo["entries"], memo["max"], memo["gets"]))
+                print("  opcodes:")
+                for name, count in stats["opcodes"].items():
+                    print("    %-16s %d" % (name, count))
+                print("  largest payloads:")
+                for size, name, offset in stats["payloads"]:
+                    print("    %-16s %d bytes at offset %d"
+                          % (name, size, offset))
+                print("  globals:")
+                for (module, name), offsets in stats["globals"].items():
+                    print("    %s.%s: %d reference(s), first at offset %d"
+                          % (module, name, len(offsets), offsets[0]))
         else:
             import pprint
             for f in args.pickle_file: